@@ -14,10 +14,12 @@ import os
 import sys
 import time
 import ctypes
+import errno
+import mmap
+import select
 import threading
 import traceback
 import socket
-import inspect
 import json
 import re
 
@@ -72,6 +74,50 @@ def _hasitems(obj):
     return not isinstance(obj, _string) and hasattr(obj, '__getitem__')
 
 
+def _transpose(block, out=None, columns=None):
+    """Copy block[sample,channel] into channel rows out[channel,sample].
+
+    The transposed copy runs in cache sized slabs of samples; columns
+    selects the channels, in the order of the rows.
+    """
+    if columns is not None and len(columns) == block.shape[1]:
+        if list(columns) == list(xrange(block.shape[1])):
+            columns = None
+    width = block.shape[1] if columns is None else len(columns)
+    if out is None:
+        out = numpy.empty((width, block.shape[0]), block.dtype)
+    for i in xrange(0, block.shape[0], 4096):
+        if columns is None:
+            out[:, i:i+4096] = block[i:i+4096].T
+        else:
+            out[:, i:i+4096] = block[i:i+4096, columns].T
+    return out
+
+
+def _envelope(data, decim):
+    """Reduce data to the min, max and mean of each decim samples.
+
+    A shorter last window is reduced on its own.
+    """
+    full = data.shape[0] // decim * decim
+    windows = data[:full].reshape(-1, decim)
+    envelope = [windows.min(1), windows.max(1),
+                windows.mean(1, dtype='float32')]
+    if full < data.shape[0]:
+        tail = data[full:]
+        envelope = [
+            numpy.append(values, reduced).astype(values.dtype)
+            for values, reduced in zip(envelope, (
+                tail.min(), tail.max(), tail.mean(dtype='float32')))]
+    return envelope
+
+
+def _deinterleave(block, nchan, out=None):
+    """Demux int16[sample*nchan] frames into rows out[nchan,sample]."""
+    return _transpose(
+        block[:block.size // nchan * nchan].reshape(-1, nchan), out)
+
+
 run_test = False
 plot_channel = -1
 debug = 0
@@ -106,6 +152,7 @@ _ao_oneshot_cs = 54200  # sha1sum
 _ao_oneshot = 54201
 _ao_oneshot_re = 54202
 _zclk_freq = 33333300
+_applied_folder = None  # <tempdir>/acq4xx_applied
 
 
 class _es_marker:
@@ -152,6 +199,474 @@ class _es_marker:
     class int16:
         static = 0xaa55 - (1 << 16)
 
+    @staticmethod
+    def scan(a):
+        """Find the marker rows of a block a[sample, channel].
+
+        Returns the row indices and their int32 clock counts. Rows of
+        multiples of 4 channels are read as little endian 64 bit words,
+        each topped by a static word, so the candidates come from one
+        compare of the first word.
+        """
+        static = _es_marker.uint16.static
+        if a.shape[1] % 4 == 0 and a.dtype.itemsize == 2 and (
+                a.flags.c_contiguous):
+            w = a.view('<u8')
+            marks = numpy.flatnonzero((w[:, 0] >> 48) == static)
+            marks = marks[((w[marks] >> 48) == static).all(1)]
+            return marks, (w[marks, 1] & 0xffffffff).astype(
+                '<u4').view('<i4')
+        column = a[:, _es_marker.static]
+        marks = numpy.flatnonzero(column[:, 0] == _es_marker.int16.static)
+        marks = marks[(column[marks] == _es_marker.int16.static).all(1)]
+        return marks, numpy.ascontiguousarray(
+            a[marks, _es_marker.count]).view('<i4')[:, 0]
+
+
+class _es_buffer(object):
+    """Reassemble the sample rows between event markers.
+
+    Rows are copied once into a preallocated array; view() hands out the
+    leading rows without a copy, valid until the next append or consume.
+    """
+
+    def __init__(self, nrows, ncols, dtype='int16'):
+        self.data = numpy.empty((2*nrows, ncols), dtype)
+        self.size = 0
+
+    def __len__(self): return self.size
+
+    def append(self, rows):
+        end = self.size+rows.shape[0]
+        if end > self.data.shape[0]:
+            data = numpy.empty(
+                (max(end, 2*self.data.shape[0]), self.data.shape[1]),
+                self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:end] = rows
+        self.size = end
+
+    def view(self, nrows=None):
+        return self.data[:self.size if nrows is None else nrows]
+
+    def consume(self, nrows):
+        rest = self.size-nrows
+        self.data[:rest] = self.data[nrows:self.size]
+        self.size = rest
+
+    def clear(self):
+        self.size = 0
+
+
+class _buffer_pool(object):
+    """Fixed set of reusable page aligned buffers of size bytes.
+
+    get() blocks while all are in use; exhausted counts these waits and
+    wait_seconds sums them up, i.e. the back-pressure of the consumer.
+    A buffer kept with hold() returns to the pool with the last put().
+    """
+
+    def __init__(self, size, count=4, buffers=None):
+        if buffers is None:
+            buffers = [mmap.mmap(-1, size) for i in xrange(count)]
+        self.size = size
+        self.count = len(buffers)
+        self.exhausted = 0
+        self.wait_seconds = 0.
+        self._holds = {}
+        self._lock = threading.Lock()
+        self._free = queue.Queue()
+        for buf in buffers:
+            self._free.put(buf)
+
+    def __str__(self):
+        return "pool(%d x %d bytes, exhausted %d times, %.3fs)" % (
+            self.count, self.size, self.exhausted, self.wait_seconds)
+
+    def get(self, timeout=None):
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            self.exhausted += 1
+        t = time.time()
+        try:
+            return self._free.get(timeout=timeout)
+        finally:
+            self.wait_seconds += time.time()-t
+
+    def hold(self, buf):
+        with self._lock:
+            self._holds[id(buf)] = self._holds.get(id(buf), 0) + 1
+
+    def put(self, buf):
+        with self._lock:
+            holds = self._holds.pop(id(buf), 0)
+            if holds > 1:
+                self._holds[id(buf)] = holds - 1
+        if not holds:
+            self._free.put(buf)
+
+
+class _writer_stage(object):
+    """Store the blocks of a stream in writer threads.
+
+    Writer k stores every n-th channel from k, so each node is written by
+    one thread and in order. Each writer holds up to depth blocks; when a
+    writer is full, policy 'block' waits, 'spill' saves the block to a
+    file in folder and 'drop' discards it. blocks, dropped, spilled,
+    max_depth and max_lag (seconds from queued to stored) tell how far
+    the writers fall behind.
+    """
+    policies = ('block', 'spill', 'drop')
+
+    def __init__(self, stream, writers=1, depth=8, policy='block',
+                 folder=None):
+        if policy not in self.policies:
+            raise Exception("invalid writer policy %r" % (policy,))
+        self.stream = stream
+        self.depth = depth
+        self.policy = policy
+        self.folder = folder
+        self.blocks = self.dropped = self.spilled = self.max_depth = 0
+        self.lag = self.max_lag = 0.
+        self.error = None
+        self.cond = threading.Condition()
+        self.queued = [[] for i in xrange(writers)]
+        self.in_memory = [0] * writers
+        self.threads = []
+        for k in xrange(writers):
+            thread = threading.Thread(
+                target=self.write, args=(k,),
+                name="%s.writer%d" % (stream.name, k))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def __str__(self):
+        return ("writers(%d, %s): %d blocks, %d spilled, %d dropped, "
+                "max depth %d, max lag %.3fs") % (
+            len(self.threads), self.policy, self.blocks, self.spilled,
+            self.dropped, self.max_depth, self.max_lag)
+
+    @property
+    def queue_depth(self):
+        return max(len(q) for q in self.queued)
+
+    def _full(self): return max(self.in_memory) >= self.depth
+
+    def _spill(self, block):
+        import tempfile  # not needed unless writers spill
+        if self.folder is None:
+            self.folder = tempfile.gettempdir()
+        fd, path = tempfile.mkstemp('.npy', 'acq4xx_spill_', self.folder)
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, block)
+        return path
+
+    def put(self, i0, block):
+        """Queue block; it is kept in its receive buffer, else copied."""
+        with self.cond:
+            if self.error is None and self.policy == 'block':
+                while self._full() and self.error is None:
+                    self.cond.wait()
+            if self.error is not None:
+                raise self.error
+            full = self._full()
+        if full and self.policy == 'drop':
+            self.dropped += 1
+            return
+        held = None
+        if full:
+            data = self._spill(block)
+        else:
+            data, held = self.stream.hand_over(block)
+        item = [time.time(), i0, data, len(self.queued), held]
+        with self.cond:
+            for k, q in enumerate(self.queued):
+                q.append(item)
+                if not full:
+                    self.in_memory[k] += 1
+            self.blocks += 1
+            self.spilled += full
+            self.max_depth = max(self.max_depth, self.queue_depth)
+            self.cond.notify_all()
+
+    def write(self, k):
+        q, part = self.queued[k], (k, len(self.queued))
+        while True:
+            with self.cond:
+                while not q:
+                    self.cond.wait()
+                item = q.pop(0)
+            if item is None:
+                return
+            queued, i0, data, refs, held = item
+            spilled = not isinstance(data, numpy.ndarray)
+            try:
+                if self.error is None:
+                    self.stream.store(
+                        i0, numpy.load(data) if spilled else data, part)
+            except Exception as e:
+                traceback.print_exc()
+                self.error = e
+            with self.cond:
+                item[3] -= 1
+                if spilled:
+                    if not item[3]:
+                        os.remove(data)
+                else:
+                    self.in_memory[k] -= 1
+                    if not item[3] and held is not None:
+                        held[0].put(held[1])
+                self.lag = time.time()-queued
+                self.max_lag = max(self.max_lag, self.lag)
+                self.cond.notify_all()
+
+    def close(self):
+        """Let the writers store what is queued and wait for them."""
+        with self.cond:
+            for q in self.queued:
+                q.append(None)
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        if debug > 0:
+            dprint("[%s] %s", self.stream.name, self)
+        if self.error is not None:
+            raise self.error
+
+
+class _tap(object):
+    """Shared memory ring of the received blocks for local live readers.
+
+    The blocks are received straight into the slots of /dev/shm/<name>,
+    so publishing costs neither a copy nor a lock. The file starts with
+    a page of header and channel map (int16, -1 terminated), each slot
+    with a page of slot header before its data. A slot's seq is odd
+    while it is filled; readers check it is even and unchanged after
+    copying, see attach() and read().
+    """
+    magic = b'acq4xtap'
+    page = mmap.PAGESIZE
+    header_dtype = numpy.dtype([
+        ('magic', 'S8'), ('nslots', '<u4'), ('nChannels', '<u4'),
+        ('slot_size', '<u8'), ('clock', '<f8'), ('head', '<i8')])
+    slot_dtype = numpy.dtype([
+        ('seq', '<u8'), ('block', '<i8'), ('i0', '<i8'),
+        ('samples', '<i8'), ('count', '<i8')])
+
+    def __init__(self, name, nslots=0, slot_size=0, nChannels=0,
+                 chanlist=None, clock=0, has_es=False):
+        """Create the ring name, or attach read-only if nslots is 0."""
+        self.path = os.path.join('/dev/shm', name)
+        self.has_es = has_es
+        if not nslots:
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._layout()
+            if self.header['magic'] != self.magic:
+                raise Exception("%s is no acq4xx tap" % self.path)
+            return
+        stride = -(-slot_size // self.page) * self.page
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, self.page + nslots * (self.page + stride))
+            self._map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        header = numpy.frombuffer(self._map, self.header_dtype, 1)
+        header[0] = (self.magic, nslots, nChannels, slot_size, clock, -1)
+        chanmap = numpy.frombuffer(
+            self._map, '<i2', self.page // 2 - 32, 64)
+        chanlist = list(chanlist or xrange(nChannels))[:chanmap.size-1]
+        chanmap[:len(chanlist)] = chanlist
+        chanmap[len(chanlist)] = -1
+        self._layout()
+        self.slots = [memoryview(self._map)[off:off+slot_size]
+                      for off in self._offsets]
+        self._index = dict((id(buf), i) for i, buf in enumerate(self.slots))
+        self.block = self.i0 = 0
+
+    def _layout(self):
+        self.header = numpy.frombuffer(self._map, self.header_dtype, 1)[0]
+        nslots, size = int(self.header['nslots']), self.header['slot_size']
+        stride = -(-int(size) // self.page) * self.page
+        self._offsets = [self.page + i * (self.page + stride) + self.page
+                         for i in xrange(nslots)]
+        self.slot = [numpy.frombuffer(self._map, self.slot_dtype, 1,
+                                      off - self.page)[0]
+                     for off in self._offsets]
+
+    @property
+    def chanlist(self):
+        chanmap = numpy.frombuffer(self._map, '<i2', self.page // 2 - 32, 64)
+        return chanmap[:numpy.flatnonzero(chanmap < 0)[0]].tolist()
+
+    def begin(self, buf):
+        """Mark the slot of pool buffer buf as being filled."""
+        self.slot[self._index[id(buf)]]['seq'] += 1
+
+    def publish(self, buf, nbytes):
+        """Describe the nbytes filled into buf and mark it valid."""
+        slot = self.slot[self._index[id(buf)]]
+        nChannels = int(self.header['nChannels'])
+        samples = nbytes // nChannels // 2
+        if not samples:  # end of stream
+            slot['block'] = -1
+            slot['seq'] += 1
+            return
+        count = -1
+        if self.has_es:
+            counts = _es_marker.scan(numpy.frombuffer(
+                buf, '<i2', samples * nChannels).reshape(-1, nChannels))[1]
+            if counts.size:
+                count = counts[0]
+        slot['block'], slot['i0'] = self.block, self.i0
+        slot['samples'], slot['count'] = samples, count
+        slot['seq'] += 1
+        self.header['head'] = self.block
+        self.block += 1
+        self.i0 += samples
+
+    def read(self, block):
+        """Copy block from the ring as (i0, count, data[sample, channel]).
+
+        Returns None if the block is not, or no longer, in the ring.
+        """
+        for i, slot in enumerate(self.slot):
+            seq = int(slot['seq'])
+            if seq and not seq & 1 and slot['block'] == block:
+                break
+        else:
+            return None
+        nChannels = int(self.header['nChannels'])
+        i0, count, samples = int(slot['i0']), int(slot['count']), int(
+            slot['samples'])
+        data = numpy.frombuffer(
+            self._map, '<i2', samples * nChannels, self._offsets[i]
+        ).reshape(samples, nChannels).copy()
+        if int(slot['seq']) != seq:
+            return None
+        return i0, count, data
+
+    @property
+    def head(self): return int(self.header['head'])
+
+    def close(self):
+        """Unlink the ring; attached readers keep their mapping."""
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class _capture(object):
+    """Write-ahead capture of the raw blocks of a stream.
+
+    A capture is a folder with data, the blocks appended through a
+    sliding memory map, index, records of byte offset, first sample and
+    samples per block, markers, records of block, row and clock count of
+    the event markers, and meta.json. Open an existing one with meta None.
+    """
+    chunk = 1 << 28  # bytes mapped at a time
+    index_dtype = numpy.dtype(
+        [('offset', '<i8'), ('i0', '<i8'), ('samples', '<i8')])
+    marker_dtype = numpy.dtype(
+        [('block', '<i8'), ('row', '<i8'), ('count', '<i8')])
+
+    @staticmethod
+    def folder(folder=None):
+        if folder is None:
+            import tempfile  # not needed unless captures are used
+            folder = tempfile.gettempdir()
+        return folder
+
+    def __init__(self, path, meta=None):
+        self.path = path
+        if meta is None:
+            with open(os.path.join(path, 'meta.json')) as f:
+                self.meta = json.load(f)
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.meta = meta
+        self.blocks = self.samples = self.size = self._base = 0
+        self._map = self._view = None
+        self._write_meta()
+        self._data = open(os.path.join(path, 'data'), 'w+b')
+        self._index = open(os.path.join(path, 'index'), 'wb')
+        self._markers = open(os.path.join(path, 'markers'), 'wb')
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def _unmap(self):
+        if self._map is not None:
+            self._view = None
+            self._map.close()
+            self._map = None
+
+    def _remap(self):
+        self._unmap()
+        self._base = self.size
+        self._data.truncate(self._base+self.chunk)
+        self._map = mmap.mmap(
+            self._data.fileno(), self.chunk, offset=self._base)
+        self._view = numpy.frombuffer(self._map, numpy.uint8)
+
+    def append(self, i0, block):
+        raw = numpy.ascontiguousarray(block).reshape(-1).view(numpy.uint8)
+        offset = pos = self.size
+        while pos < offset+raw.size:
+            if self._map is None or self.size >= self._base+self.chunk:
+                self._remap()
+            at = self.size-self._base
+            num = min(offset+raw.size-pos, self.chunk-at)
+            self._view[at:at+num] = raw[pos-offset:pos-offset+num]
+            pos = self.size = self.size+num
+        self._index.write(numpy.array(
+            [(offset, i0, block.shape[0])], self.index_dtype).tobytes())
+        if self.meta.get('has_es'):
+            marks, counts = _es_marker.scan(block)
+            markers = numpy.empty(marks.size, self.marker_dtype)
+            markers['block'], markers['row'] = self.blocks, marks
+            markers['count'] = counts
+            self._markers.write(markers.tobytes())
+        self.blocks += 1
+        self.samples += block.shape[0]
+
+    def close(self):
+        self._unmap()
+        self._data.truncate(self.size)
+        for f in (self._data, self._index, self._markers):
+            f.close()
+        self.meta.update(blocks=self.blocks, samples=self.samples)
+        self._write_meta()
+
+    def index(self):
+        return numpy.fromfile(
+            os.path.join(self.path, 'index'), self.index_dtype)
+
+    def markers(self):
+        return numpy.fromfile(
+            os.path.join(self.path, 'markers'), self.marker_dtype)
+
+    def read(self):
+        """Yield the captured blocks as read-only [sample, channel]."""
+        index = self.index()
+        if not index.size:
+            return
+        nchan = self.meta['nChannels']
+        dtype = numpy.dtype(self.meta['dtype'])
+        data = numpy.memmap(
+            os.path.join(self.path, 'data'), dtype, mode='r')
+        for offset, i0, samples in index.tolist():
+            first = offset // dtype.itemsize
+            yield data[first:first+samples*nchan].reshape(samples, nchan)
+
 
 class AO_MODE:
     """Define AO modes."""
@@ -165,6 +680,224 @@ class AO_MODE:
 # -----------------
 
 
+class _line_reader(object):
+    """Buffered line framing of a socket stream.
+
+    Data is read with large recv_into calls into a reusable buffer; lines
+    are split off in place. A partial line is kept until its newline
+    arrives, several coalesced lines are returned one by one.
+    """
+
+    def __init__(self, sock, size=65536):
+        self.sock = sock
+        self._buf = bytearray(size)
+        self._start = self._end = 0
+
+    def _fill(self):
+        """Receive more data; return the number of bytes read."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        elif self._end == len(self._buf):
+            if self._start == 0:  # a single line fills the buffer
+                self._buf.extend(bytearray(len(self._buf)))
+            else:
+                size = self._end - self._start
+                self._buf[:size] = self._buf[self._start:self._end]
+                self._start, self._end = 0, size
+        view = memoryview(self._buf)[self._end:]
+        nbytes = self.sock.recv_into(view)
+        self._end += nbytes
+        return nbytes
+
+    def readline(self):
+        """Return the next line incl. newline; b'' on EOF.
+
+        A trailing line without newline is returned when the peer closes.
+        Timeouts of the socket propagate and leave partial data buffered.
+        """
+        while True:
+            idx = self._buf.find(b'\n', self._start, self._end)
+            if idx >= 0:
+                end = idx + 1
+                break
+            if not self._fill():
+                end = self._end
+                break
+        line = bytes(self._buf[self._start:end])
+        self._start = end
+        return line
+
+    def readlines(self):
+        """Receive once and return the complete lines; None on EOF.
+
+        Meant for sockets that select reported readable.
+        """
+        if not self._fill():
+            return None
+        lines = []
+        while True:
+            idx = self._buf.find(b'\n', self._start, self._end)
+            if idx < 0:
+                return lines
+            lines.append(bytes(self._buf[self._start:idx+1]))
+            self._start = idx + 1
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+
+class _nc_session(object):
+    """Keep-alive connection to a site service.
+
+    After 'prompt on' the site service terminates every reply with a prompt
+    'acq400.<site> <rc> >', which is used to frame the replies of pipelined
+    command lines.
+    """
+
+    _re_prompt = re.compile(b"(?:^|\n)acq400\\.[0-9]+ ([0-9]+) >[ ]*")
+    closed = False
+
+    class unsupported(socket.error):
+        """The site service does not frame its replies with a prompt."""
+
+    def __init__(self, server, timeout=5):
+        self.server = server
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(server)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._buf = b''
+        try:
+            ok = self.transact(['prompt on'], timeout) and not self.closed
+        except socket.timeout:
+            ok = False
+        if not ok:
+            self.close()
+            raise _nc_session.unsupported(
+                '%s:%d does not support prompt' % server)
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+    def _reply(self):
+        """Return (rc, reply) of the next command or None on EOF."""
+        while True:
+            match = self._re_prompt.search(self._buf)
+            if match is not None:
+                break
+            data = self.sock.recv(4096)
+            if not data:
+                self.close()
+                if not self._buf:
+                    return None
+                res, self._buf = self._buf, b''
+                return 0, s(res).strip()
+            self._buf += data
+        res = self._buf[:match.start()]
+        self._buf = self._buf[match.end():]
+        return int(match.group(1)), s(res).strip()
+
+    def transact(self, rows, timeout=5):
+        """Send command rows in one go and return [(rc, reply), ...].
+
+        The list is shorter than rows if the server closed the connection.
+        """
+        self.sock.settimeout(timeout)
+        self.sock.sendall(b(''.join(row + '\n' for row in rows)))
+        res = []
+        for _ in rows:
+            reply = self._reply()
+            if reply is None:
+                break
+            res.append(reply)
+            if self.closed:
+                break
+        return res
+
+
+class _nc_pool(object):
+    """Pool of keep-alive site service sessions per (host, port).
+
+    connects counts the opened connections, saved the number of
+    transactions that were served by an already open session.
+    """
+
+    _lock = threading.Lock()
+    _idle = {}
+    plain = set()  # servers without prompt, see _nc._transact
+    connects = 0
+    saved = 0
+
+    @classmethod
+    def _connect(cls, server, timeout):
+        try:
+            session = _nc_session(server, timeout)
+        except _nc_session.unsupported:
+            with cls._lock:
+                cls.plain.add(server)
+            raise
+        with cls._lock:
+            cls.connects += 1
+        return session
+
+    @classmethod
+    def transact(cls, server, rows, timeout=5):
+        """Send rows via a pooled session; reconnect once if it went stale."""
+        with cls._lock:
+            idle = cls._idle.get(server)
+            session = idle.pop() if idle else None
+        reused = session is not None
+        if not reused:
+            session = cls._connect(server, timeout)
+        try:
+            try:
+                res = session.transact(rows, timeout)
+            except socket.timeout:
+                raise
+            except socket.error:  # e.g. reset by a reboot or a link drop
+                if not reused:
+                    raise
+                session.close()
+                res = []
+            if reused and not res and session.closed:
+                session = cls._connect(server, timeout)
+                reused = False
+                res = session.transact(rows, timeout)
+        except BaseException:
+            session.close()
+            raise
+        if session.closed:
+            res.extend([(0, '')] * (len(rows) - len(res)))
+            return res
+        with cls._lock:
+            if reused:
+                cls.saved += 1
+            cls._idle.setdefault(server, []).append(session)
+        return res
+
+    @classmethod
+    def close(cls, host=None):
+        """Close idle sessions, e.g. after a reboot of host."""
+        with cls._lock:
+            for server in list(cls._idle):
+                if host is None or server[0] == host:
+                    for session in cls._idle.pop(server):
+                        session.close()
+            for server in list(cls.plain):  # the firmware may have changed
+                if host is None or server[0] == host:
+                    cls.plain.discard(server)
+
+    @classmethod
+    def stats(cls):
+        with cls._lock:
+            return {
+                'connects': cls.connects,
+                'saved': cls.saved,
+                'idle': sum(len(v) for v in cls._idle.values()),
+            }
+
+
 class _nc(object):
     """Core n-etwork c-onnection to the DTACQ appliance.
 
@@ -175,6 +908,7 @@ class _nc(object):
 
     _chain = None
     _server = None
+    _pooled = False  # use keep-alive sessions of _nc_pool
     __stop = None
     @staticmethod
     def _tupletostr(value):
@@ -231,25 +965,41 @@ class _nc(object):
     def lines(self, timeout=60):
         sock = self.sock
         sock.settimeout(timeout)
-
-        def gen():
-            while self.on:
-                c = sock.recv(1)
-                if not c:
-                    break
-                yield c
-                if c == b'\n':
-                    break
-
+        reader = _line_reader(sock)
         try:
             while self.on:
-                line = b''.join(gen())
+                line = reader.readline()
                 if not line:
                     break
                 yield line
         finally:
             sock.close()
 
+    def _transact(self, rows, timeout=5):
+        """Send command rows in one round trip; return [(rc, reply), ...].
+
+        Site services without prompt get one connection per row instead.
+        """
+        if not rows:
+            return []
+        if self._server not in _nc_pool.plain:
+            try:
+                return _nc_pool.transact(self._server, rows, timeout)
+            except _nc_session.unsupported:
+                pass
+        res = []
+        for row in rows:
+            sock = self.sock
+            def recvstr(): return s(sock.recv(1024))
+            try:
+                sock.sendall(b(row))
+                sock.shutdown(socket.SHUT_WR)
+                sock.settimeout(timeout)
+                res.append((0, ''.join(iter(recvstr, '')).strip()))
+            finally:
+                sock.close()
+        return res
+
     def _com(self, cmd, ans=False, timeout=None, dbg=[None, None]):
         if _hasitems(cmd):
             cmd = '\n'.join(cmd)
@@ -262,6 +1012,15 @@ class _nc(object):
         dbg[0] = cmd
         if cmd.startswith('_'):
             traceback.print_stack()
+        if self._pooled:
+            if debug >= 3:
+                dprint('cmd: %s' % cmd)
+            rows = [row for row in cmd.split('\n') if row.strip()]
+            res = self._transact(rows, 5 if timeout is None else timeout)
+            dbg[1] = '\n'.join(reply for rc, reply in res if reply)
+            if ans:
+                return dbg[1]
+            return
         sock = self.sock
         def recvstr(): return s(sock.recv(1024))
         try:
@@ -327,20 +1086,103 @@ class _channel_nc(_nc):
         finally:
             sock.close()
 
-    def read(self, format='int16'):
-        ans = [buf for buf in self.buffer()]
-        return numpy.concatenate(ans, 0)
+    def read(self, format='int16', nsamples=None):
+        """Receive the whole channel into one array.
 
-    def raw(self, rang=None):
+        With nsamples, e.g. pre+post, the array is preallocated and filled
+        by recv_into. Without, or if the stream continues beyond, the array
+        doubles its capacity. The result is shrunk in place.
+        """
+        dtype = numpy.dtype(format)
+        data = numpy.empty(nsamples or 4194304 // dtype.itemsize, dtype)
+        view = data.view(numpy.uint8)
+        probe = bytearray(1)
+        sock = self.sock
+        got = 0
+        try:
+            while self.on:
+                if got == view.size:  # only grow if the stream continues
+                    if not sock.recv_into(probe, 1):
+                        break
+                    del(view)
+                    data.resize(max(1, data.size * 2), refcheck=False)
+                    view = data.view(numpy.uint8)
+                    view[got] = probe[0]
+                    got += 1
+                nbytes = sock.recv_into(view[got:], view.size - got)
+                if not nbytes:
+                    break
+                got += nbytes
+        finally:
+            sock.close()
+        del(view)
+        data.resize(got // dtype.itemsize, refcheck=False)
+        return data
+
+    def raw(self, rang=None, nsamples=None):
+        """Receive channel[rang]; nsamples only presizes full reads.
+
+        Slices relative to the end are resolved against the samples
+        actually received, not against nsamples.
+        """
         if rang is None:
-            return self.read()
+            return self.read(nsamples=nsamples)
         if isinstance(rang, slice):
             slic = rang
         elif _hasitems(rang):
             slic = slice(*rang)
         else:
             slic = slice(None, None, rang)
-        return self.read()[slic]
+        start, stop, step = slic.start, slic.stop, slic.step or 1
+        if step < 0 or (start or 0) < 0 or (stop or 0) < 0:
+            # relative to the end, which is only known once received
+            return self.read(nsamples=nsamples)[slic]
+        if step == 1 and not start and stop is None:
+            return self.read(nsamples=nsamples)
+        return self.read_window(start, stop, step)
+
+    def read_window(self, start=0, stop=None, step=1, format='int16',
+                    chunk=1048576):
+        """Receive channel[start:stop:step] without holding the channel.
+
+        The channel port streams from the first sample, so samples before
+        start are received and dropped, strided samples are picked from a
+        reusable chunk buffer, and the connection is closed at stop.
+        """
+        dtype = numpy.dtype(format)
+        start, step = start or 0, step or 1
+        if stop is None:
+            data = numpy.empty(chunk // dtype.itemsize, dtype)
+        else:
+            data = numpy.empty(len(range(start, stop, step)), dtype)
+        buf = numpy.empty(chunk // dtype.itemsize, dtype)
+        view = buf.view(numpy.uint8)
+        sock = self.sock
+        pos = got = rest = 0  # sample index of buf[0], samples kept, bytes
+        try:
+            while self.on and (stop is None or pos < stop):
+                nbytes = sock.recv_into(view[rest:], view.size - rest)
+                if not nbytes:
+                    break
+                rest += nbytes
+                num = rest // dtype.itemsize
+                first = max(start, pos)
+                first += (start - first) % step
+                end = num if stop is None else min(num, stop - pos)
+                if first - pos < end:
+                    picked = buf[first-pos:end:step]
+                    if got + picked.size > data.size:
+                        data.resize(max(got + picked.size, data.size * 2),
+                                    refcheck=False)
+                    data[got:got+picked.size] = picked
+                    got += picked.size
+                pos += num
+                rest -= num * dtype.itemsize
+                view[:rest] = view[num*dtype.itemsize:num*dtype.itemsize+rest]
+        finally:
+            sock.close()
+        data.resize(got, refcheck=False)
+        return data
 
 
 class _custom_awg(_nc):
@@ -450,27 +1292,7 @@ class _gpg_nc(_nc):
 
 
 class _line_logger_nc(_nc):
-    def lines(self, timeout=60):
-        sock = self.sock
-        sock.settimeout(timeout)
-
-        def gen():
-            while self.on:
-                c = sock.recv(1)
-                if not c:
-                    break  # is empty
-                yield c
-                if c == b'\n':
-                    break
-
-        try:
-            while self.on:
-                line = b''.join(gen())
-                if not line:
-                    break
-                yield line
-        finally:
-            sock.close()
+    """Line based log port, e.g. of mgt_run_shot; see _nc.lines."""
 
 
 class STATE:
@@ -491,11 +1313,123 @@ class STATE:
         """Return name of state id."""
         return cls.names[int(id)]
 
-    class logger(threading.Thread):
-        """Thread listening for the state updates on the log port."""
+    class monitor(threading.Thread):
+        """Single thread watching the state ports of all loggers.
+
+        The sockets connect non-blocking and are multiplexed with select;
+        every state line is dispatched to the logger of its host.
+        """
+
+        _instance = None
+        _connect_timeout = 3
+
+        @classmethod
+        def get(cls):
+            """Return the running monitor of this process."""
+            with STATE._lock:
+                if cls._instance is None or not cls._instance.is_alive():
+                    cls._instance = cls()
+                return cls._instance
+
+        def __init__(self):
+            super(STATE.monitor, self).__init__(name='STATE.monitor')
+            self.daemon = True
+            self._lock = threading.Lock()
+            self._added = []
+            self._wake_r, self._wake_w = socket.socketpair()
+            self.start()
+
+        def wake(self):
+            """Interrupt select, e.g. to pick up new or stopped loggers."""
+            try:
+                self._wake_w.send(b'\0')
+            except socket.error:
+                pass
+
+        def add(self, log):
+            with self._lock:
+                self._added.append(log)
+            self.wake()
+
+        def _connect(self, conns, log):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            try:
+                err = sock.connect_ex((log.name, _state_port))
+            except socket.error:  # e.g. unknown host
+                err = -1
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sock.close()
+                log._closed()
+                return
+            deadline = time.time() + self._connect_timeout
+            conns[sock] = [log, None, deadline]
+
+        @staticmethod
+        def _drop(conns, sock):
+            del(conns[sock])
+            sock.close()
+
+        def _read(self, conns, sock):
+            log, reader = conns[sock][:2]
+            try:
+                lines = reader.readlines()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                lines = None
+            if lines is None:  # reconnect as the state port went down
+                self._drop(conns, sock)
+                self._connect(conns, log)
+                return
+            for line in lines:
+                log._update(line)
+
+        def run(self):
+            conns = {}  # sock: [logger, reader or None if connecting, due]
+            try:
+                while True:
+                    with self._lock:
+                        added, self._added = self._added, []
+                    for log in added:
+                        self._connect(conns, log)
+                    now = time.time()
+                    for sock, (log, reader, due) in list(conns.items()):
+                        if not log.on:
+                            self._drop(conns, sock)
+                            log._closed()
+                        elif reader is None and now > due:
+                            self._drop(conns, sock)
+                            log._closed()
+                    connecting = [
+                        k for k, v in conns.items() if v[1] is None]
+                    rlist = [k for k, v in conns.items() if v[1] is not None]
+                    rlist.append(self._wake_r)
+                    rlist, wlist, _ = select.select(
+                        rlist, connecting, [], 1.)
+                    for sock in wlist:
+                        err = sock.getsockopt(
+                            socket.SOL_SOCKET, socket.SO_ERROR)
+                        if err:
+                            log = conns[sock][0]
+                            self._drop(conns, sock)
+                            log._closed()
+                        else:
+                            conns[sock][1] = _line_reader(sock, 4096)
+                    for sock in rlist:
+                        if sock is self._wake_r:
+                            sock.recv(4096)
+                        elif sock in conns:
+                            self._read(conns, sock)
+            finally:
+                for sock, conn in list(conns.items()):
+                    self._drop(conns, sock)
+                    conn[0]._closed()
+
+    class logger(object):
+        """State updates of a uut as dispatched by the STATE.monitor."""
 
         _initialized = False
-        _com = None
         _re_state = re.compile(b"([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+) ([0-9]+)")
 
         def __new__(cls, host='localhost', *arg, **kwarg):
@@ -511,15 +1445,15 @@ class STATE:
             """Ensure only logger only initializes once per uut."""
             if self._initialized:
                 return
-            super(STATE.logger, self).__init__(name=host)
             self._initialized = True
+            self.name = host
             self._stopped = threading.Event()
-            self.daemon = True
             self.cv = threading.Condition()
             self.debug = debug
             self._state = set()
+            self._current = None
             self.reset()
-            self.start()
+            STATE.monitor.get().add(self)
 
         @property
         def on(self):
@@ -529,62 +1463,40 @@ class STATE:
         def stop(self):
             """Request stop."""
             self._stopped.set()
+            STATE.monitor.get().wake()
 
-        def run(self):
-            """Capture states and update state history."""
-            def new_com():
-                com = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                com.settimeout(3)
-                com.connect((self.name, _state_port))
-                com.settimeout(1)
-                return com
-
-            sock_timeout = socket.timeout
-            sock_error = socket.error
-            try:
-                com = new_com()
-                try:
-                    while not self._stopped.is_set():
-                        try:
-                            msg = com.recv(1024)
-                            if not msg:
-                                raise sock_error
-                            msg = msg.strip(b'\r\n')
-                            if self.debug > 2:
-                                dprint(msg)
-                        except (SystemExit, KeyboardInterrupt):
-                            raise
-                        except sock_timeout:
-                            continue
-                        except sock_error:
-                            com.close()
-                            com = new_com()
-                            time.sleep(1)
-                            continue
-                        match = self._re_state.match(msg)
-                        if match is None:
-                            continue
-                        with self.cv:
-                            if self.debug > 1:
-                                dprint(match.group(0))
-                            statid = int(match.group(1))
-                            if statid > 5:
-                                stat = statid
-                            else:
-                                stat = STATE.get_name(statid)
-                            self._state.add(stat)
-                            self._pre = int(match.group(2))
-                            self._post = int(match.group(3))
-                            self._elapsed = int(match.group(4))
-                            self._reserved = int(match.group(5))
-                            self.cv.notify_all()
-                finally:
-                    com.close()
-            finally:
-                del(STATE._loggers[self.name])
-                with self.cv:
-                    self.stop()
-                    self.cv.notify_all()
+        def _closed(self):
+            """Called by the monitor once the state port is gone."""
+            with STATE._lock:
+                if STATE._loggers.get(self.name) is self:
+                    del(STATE._loggers[self.name])
+            with self.cv:
+                self._stopped.set()
+                self.cv.notify_all()
+
+        def _update(self, msg):
+            """Update state history from a state line."""
+            msg = msg.strip(b'\r\n')
+            if self.debug > 2:
+                dprint(msg)
+            match = self._re_state.match(msg)
+            if match is None:
+                return
+            with self.cv:
+                if self.debug > 1:
+                    dprint(match.group(0))
+                statid = int(match.group(1))
+                if statid > 5:
+                    stat = statid
+                else:
+                    stat = STATE.get_name(statid)
+                self._state.add(stat)
+                self._current = stat
+                self._pre = int(match.group(2))
+                self._post = int(match.group(3))
+                self._elapsed = int(match.group(4))
+                self._reserved = int(match.group(5))
+                self.cv.notify_all()
 
         def reset(self):
             """Reset state history before waiting for state."""
@@ -598,19 +1510,25 @@ class STATE:
 
         def wait4state(self, state):
             """Wait until state happened."""
-            if state not in STATE._map:
+            if state not in STATE.names:
                 raise Exception("No such state %s" % state)
             with self.cv:
                 while (state not in self._state) and self.on:
-                    self.cv.wait(1)
+                    self.cv.wait()
             return self.on
 
         @property
         def state(self):
-            """Return current state."""
+            """Return the states seen since reset."""
             with self.cv:
                 return set(self._state)
 
+        @property
+        def current(self):
+            """Return the last reported state; None before the first."""
+            with self.cv:
+                return self._current
+
         @property
         def pre(self):
             """Return current pre."""
@@ -698,7 +1616,31 @@ class _KNOBS:
 
     @classmethod
     def prop_grp(cls, name, prop, knobs={}, fields={}):
-        return cls.setup(type(name, (prop,), fields), knobs)
+        return cls._lazy(name, prop, knobs, fields)
+
+    class _lazy(object):
+        """Placeholder of a knob group; builds the class on first access."""
+
+        def __init__(self, name, prop, knobs, fields):
+            self._args = name, prop, knobs, fields
+            self._cls = None
+
+        def __get__(self, inst, cls):
+            if self._cls is None:
+                name, prop, knobs, fields = self._args
+                self._cls = _KNOBS.setup(type(name, (prop,), fields), knobs)
+            return type(self._cls).__get__(self._cls, inst, cls)
+
+    class _grp_type(type):
+        """Bind group classes to their parent on first instance access."""
+
+        def __get__(self, inst, cls):
+            if inst is None:
+                return self
+            grp = self(inst)
+            inst.__dict__[
+                self.__name__.replace(':', '_').replace('.', '_')] = grp
+            return grp
 
     class _str(object):
         ro = False
@@ -708,12 +1650,12 @@ class _KNOBS:
         def __get__(self, inst, cls):
             if inst is None:
                 return self
-            return self._rcast(inst(cmd=self._cmd))
+            return self._rcast(inst(cmd=self._cmd, knob=self))
 
         def __set__(self, inst, value):
             if self.ro:
                 raise AttributeError
-            return inst(cmd=self._cmd, value=self._wcast(value))
+            return inst(cmd=self._cmd, value=self._wcast(value), knob=self)
 
         def __init__(self, cmd, ro=False, doc=None, cmd2=None):
             if doc is not None:
@@ -750,7 +1692,7 @@ class _KNOBS:
         def _rcast(val):
             return tuple(float(v) for v in val.split(' ', 1)[1].split(' '))
 
-    class _grp(object):
+    class _grp(_grp_type('_grp', (object,), {})):
         _parent = None
 
         def __call__(self, cmd, value=None, **kw):
@@ -773,20 +1715,6 @@ class _KNOBS:
             self._parent = parent
             if doc is not None:
                 self.__doc__ = doc
-            for k, v in self.__class__.__dict__.items():
-                if isinstance(v, type) and issubclass(v, (_KNOBS._grp,)):
-                    self.__dict__[k] = v(self)
-
-        def __getattribute__(self, name):
-            v = super(_KNOBS._grp, self).__getattribute__(name)
-            if name.startswith('_'):
-                return v
-            if isinstance(v, type):
-                if issubclass(v, (_KNOBS._grp,)):
-                    return v(self)
-                elif issubclass(v, (_KNOBS._str,)):
-                    return v(self).__get__(self, self.__class__)
-            return v
 
         def __getattr__(self, name):
             if name.startswith('_'):
@@ -814,7 +1742,8 @@ class _KNOBS:
             cmd = self.__class__.__name__ if self._cmd is None else self._cmd
             value = ' '.join(map(str, a)) if a else self._args
             return self._parent(
-                cmd=cmd, value=value, timeout=self._timeout, ans=self._ans)
+                cmd=cmd, value=value, timeout=self._timeout, ans=self._ans,
+                knob=self)
 
     class _idx(_grp, _str):
         _format_idx = '%d'
@@ -830,10 +1759,11 @@ class _KNOBS:
             return '%s %s' % (self.get(idx), self._wcast(value))
 
         def __getitem__(self, idx):
-            return self._rcast(self._parent(self.get(idx)).strip(self._strip))
+            return self._rcast(
+                self._parent(self.get(idx), knob=self).strip(self._strip))
 
         def __setitem__(self, idx, value):
-            return self._parent(self.set(idx, value))
+            return self._parent(self.set(idx, value), knob=self)
 
         def setall(self, value):
             return [self.set(i+1, v) for i, v in enumerate(value)]
@@ -1051,7 +1981,8 @@ class _carrier_knobs(_dtacq_knobs):
     def off_slo(self, *sites):  # custom"Reboot carrier with sync;sync;reboot."
         if len(sites) == 1 and _hasitems(sites[0]):
             sites = sites[0]
-        res = self('off_slo %s' % (self._tupletostr(sites),)).strip()
+        res = self._read('off_slo %s' % (self._tupletostr(sites),), 60.)
+        res = res.strip()
         off_slo = [[float(c) for c in r.split(' ')] for r in res.split('\n')]
         return _zipped(*off_slo)
 
@@ -1062,8 +1993,9 @@ class _carrier_knobs(_dtacq_knobs):
         self('set_abort')
         return self
 
-    def transient(
-            self, pre=None, post=None, osam=None, soft_out=None, demux=None):
+    @staticmethod
+    def _transient_cmd(pre=None, post=None, osam=None, soft_out=None,
+                       demux=None):
         cmd = 'transient'
         if pre is not None:
             cmd += ' PRE=%d' % (pre,)
@@ -1075,21 +2007,30 @@ class _carrier_knobs(_dtacq_knobs):
             cmd += ' SOFT_TRIGGER=%d' % (1 if soft_out else 0,)
         if demux is not None:
             cmd += ' DEMUX=%d' % (1 if demux else 0,)
+        return cmd
+
+    def transient(
+            self, pre=None, post=None, osam=None, soft_out=None, demux=None):
+        cmd = self._transient_cmd(pre, post, osam, soft_out, demux)
         ans = self(cmd)
         if cmd.endswith('transient'):
             glob = {}
             exec(ans.split('\n')[-1].replace(' ', ';')) in {}, glob
             return glob
 
+    def _transient_items(self, pre, post, osam, soft_out, repeat, demux):
+        return [
+            ('TRANSIENT:PRE', int(pre)),
+            ('TRANSIENT:POST', int(post)),
+            ('TRANSIENT:OSAM', int(osam)),
+            ('TRANSIENT:SOFT_TRIGGER', 1 if soft_out else 0),
+            ('TRANSIENT:REPEAT', int(repeat)),
+            self._transient_cmd(pre, post, osam, soft_out, demux),
+        ]
+
     def TRANSIENT_ALL(self, pre, post, osam, soft_out, repeat, demux):
-        self._com('\n'.join([
-            'TRANSIENT:PRE %d' % pre,
-            'TRANSIENT:POST %d' % post,
-            'TRANSIENT:OSAM %d' % osam,
-            'TRANSIENT:SOFT_TRIGGER %d' % (1 if soft_out else 0),
-            'TRANSIENT:REPEAT %d' % repeat,
-        ]))
-        self.transient(pre, post, osam, soft_out, demux)
+        self.transaction(self._transient_items(
+            pre, post, osam, soft_out, repeat, demux)).check()
 
     def STREAM_OPTS(self, raw=None, subset=None, nowhere=False):  # package.w7x
         if nowhere:
@@ -1273,13 +2214,70 @@ class _ao420_knobs(_module_knobs):
 # --------------------
 # HINT 2 dtacq nc classes
 # --------------------
+class _nc_result(dict):
+    """Replies of a transaction by knob; failed knobs are in errors.
+
+    A knob that is read and set in one transaction keeps the reply of the
+    read; replies lists (row, reply) of all rows in order. Settings that
+    were unchanged since the last init and therefore not sent are listed
+    in skipped.
+    """
+
+    def __init__(self, rows, res, skipped=None):
+        super(_nc_result, self).__init__()
+        self.errors = {}
+        self.replies = []
+        self.skipped = {} if skipped is None else skipped
+        for row, (rc, reply) in zip(rows, res):
+            cmd, _, value = row.partition(' ')
+            if reply.startswith(cmd):
+                reply = reply[len(cmd)+1:].strip()
+            self.replies.append((row, reply))
+            if rc != 0 or reply.startswith('ERROR'):
+                self.errors[cmd] = reply or 'rc=%d' % (rc,)
+            elif not (value.strip() and cmd in self):
+                self[cmd] = reply
+        for row in rows[len(res):]:
+            self.replies.append((row, None))
+            self.errors[row.split(' ', 1)[0]] = 'no reply'
+
+    def check(self):
+        """Raise on any failed command, return self otherwise."""
+        if self.errors:
+            raise Exception('; '.join(
+                '%s: %s' % item for item in sorted(self.errors.items())))
+        return self
+
+
 class _dtacq_nc(_nc, _dtacq_knobs):
+    _pooled = True
+    _init_mode = False
+    _site = None
     _exclude = []
     _transient = ['state', 'shot']
+    _nodiff = ['run0', 'play0', 'transient']  # commands with side effects
+    _applied = {}
+    _applied_lock = threading.Lock()
     _help = None
     _helpA = None
     cache = None
     _cache = {}
+    _read_caches = {}
+    _read_lock = threading.Lock()
+    _read_ttl = (  # seconds a reading stays valid, first match by knob class
+        (_KNOBS._list_float, 60.),  # e.g. calibration AI:CAL:ESLO/EOFF
+        (_KNOBS._list_int, 10.),
+        (_KNOBS._str, 1.),
+    )
+    # knobs that reflect the live state and must always be read
+    _volatile = [
+        'ACTIVE', 'COUNT', 'CTR', 'CUR', 'FREQ', 'JC_LOL', 'JC_LOS', 'LOL',
+        'NBU', 'OSTATE', 'READY', 'RSTATE', 'STA', 'STATE', 'STATUS',
+        'TRAIN', 'TRAIN_BSY', 'TRAIN_REQ', 'UNTIL', 'acq480_loti',
+        'run', 'run0_ready', 'task_active', 'temp',
+    ]
+    _volatile_grp = ['TRANS_ACT']
+    _queries = ['off_slo', 'help', 'helpA']  # commands with args w/o effect
 
     @classmethod
     def add_cache(cls, host):
@@ -1289,16 +2287,122 @@ class _dtacq_nc(_nc, _dtacq_knobs):
     def remove_cache(cls, host):
         return cls._cache.pop(host)
 
+    @classmethod
+    def add_read_cache(cls, host):
+        """Enable the read-through knob cache for all sites of host."""
+        with cls._read_lock:
+            cls._read_caches.setdefault(host, {
+                'hits': 0, 'misses': 0, 'values': {}, 'plain': {}})
+
+    @classmethod
+    def remove_read_cache(cls, host):
+        with cls._read_lock:
+            return cls._read_caches.pop(host, None)
+
+    @classmethod
+    def read_cache_stats(cls, host):
+        """Return hits, misses and size of the read cache of host."""
+        with cls._read_lock:
+            rcache = cls._read_caches.get(host, None)
+            if rcache is None:
+                return None
+            return {
+                'hits': rcache['hits'],
+                'misses': rcache['misses'],
+                'size': sum(len(v) for v in rcache['values'].values()),
+            }
+
+    def _cacheable(self, cmd):
+        return not (
+            cmd in self._transient or
+            cmd.endswith(':RESET') or
+            cmd.rsplit(':', 1)[-1] in self._volatile or
+            cmd.split(':', 1)[0] in self._volatile_grp
+        )
+
+    def _read(self, cmd, ttl, **kw):
+        """Read cmd, through the read cache if enabled for ttl seconds."""
+        rcache = self._read_caches.get(self._server[0], None)
+        if rcache is None or ttl <= 0 or not self._cacheable(cmd):
+            return super(_dtacq_nc, self).__call__(cmd, **kw)
+        port, now = self._server[1], time.time()
+        with self._read_lock:
+            values = rcache['values'].setdefault(port, {})
+            hit = values.get(cmd, None)
+            if hit is not None and hit[0] > now:
+                rcache['hits'] += 1
+                return hit[1]
+            rcache['misses'] += 1
+        res = super(_dtacq_nc, self).__call__(cmd, **kw)
+        with self._read_lock:
+            values[cmd] = (now + ttl, res)
+        return res
+
+    def _invalidate(self, rows=None):
+        """Drop cached readings affected by rows; all if rows is None.
+
+        Writes to knobs known to be plain settings only drop that knob.
+        """
+        rcache = self._read_caches.get(self._server[0], None)
+        if rcache is None:
+            return
+        port = self._server[1]
+        with self._read_lock:
+            values = rcache['values'].get(port, None)
+            if not values:
+                return
+            if rows is None:
+                values.clear()
+                return
+            plain = rcache['plain'].get(port, ())
+            for row in rows:
+                knob, _, value = row.partition(' ')
+                if not value.strip() or knob in self._queries:
+                    continue
+                if knob not in plain:
+                    values.clear()
+                    return
+                values.pop(knob, None)
+
+    def __call__(self, cmd, value=None, knob=None, **kw):
+        if knob is None or not self._read_caches:
+            return super(_dtacq_nc, self).__call__(cmd, value, **kw)
+        rcache = self._read_caches.get(self._server[0], None)
+        if rcache is None:
+            return super(_dtacq_nc, self).__call__(cmd, value, **kw)
+        if not isinstance(knob, _KNOBS._str):  # _exe may change anything
+            self._invalidate()
+            return super(_dtacq_nc, self).__call__(cmd, value, **kw)
+        # indexed writes, e.g. _idx.__setitem__, carry the value in cmd
+        name, _, arg = cmd.strip().partition(' ')
+        with self._read_lock:
+            rcache['plain'].setdefault(self._server[1], set()).add(name)
+        if value is not None or arg.strip():
+            self._invalidate([cmd if value is None else '%s %s' % (
+                name, value)])
+            return super(_dtacq_nc, self).__call__(cmd, value, **kw)
+        for cls, ttl in self._read_ttl:
+            if isinstance(knob, cls):
+                break
+        else:
+            ttl = 0
+        return self._read(name, ttl, **kw)
+
     def __init__(self, server, site):
-        super(_dtacq_nc, self).__init__((server, _sys_port+site))
-        for cls in self.__class__.mro():
-            for k, v in cls.__dict__.items():
-                if isinstance(v, type) and k not in self.__dict__:
-                    if issubclass(v, (_KNOBS._grp,)):
-                        self.__dict__[k] = v(self)
-        self.cache = self._cache.get(server, None)
-        if self.cache is not None:
-            self.cache = self.cache.setdefault(str(site), {})
+        """Connect to the site service; knob groups bind on first access.
+
+        Failing attribute sets only fall back to instance attributes while
+        _init_mode is set, i.e. during this __init__.
+        """
+        self.__dict__['_init_mode'] = True
+        try:
+            super(_dtacq_nc, self).__init__((server, _sys_port+site))
+            self._site = site
+            self.cache = self._cache.get(server, None)
+            if self.cache is not None:
+                self.cache = self.cache.setdefault(str(site), {})
+        finally:
+            self.__dict__['_init_mode'] = False
 
     def filter_result(self, cmd, res, val):
         cmd = cmd.strip()
@@ -1315,10 +2419,186 @@ class _dtacq_nc(_nc, _dtacq_knobs):
             res = None if not val else val[0]
         return cmd, res
 
+    def _update_cache(self, rows, replies):
+        for row, res in zip(rows, replies):
+            cmd = row.strip().split(' ', 2)
+            cmd, res = self.filter_result(cmd[0], res, cmd[1:])
+            if res is not None:
+                self.cache[cmd] = res
+
+    def _transact(self, rows, timeout=5):
+        res = super(_dtacq_nc, self)._transact(rows, timeout)
+        if self._read_caches:
+            self._invalidate(rows)
+        if self.cache is not None:
+            self._update_cache(
+                rows, [reply if rc == 0 else '' for rc, reply in res])
+        return res
+
+    def transaction(self, items, timeout=5, diff=False):
+        """Send sets and gets in one round trip.
+
+        items: commands or (knob, value) tuples, a value of None queries the
+        knob. Returns a _nc_result with the replies of all knobs.
+        diff: skip settings that did not change since the last applied
+        snapshot loaded with add_applied.
+        """
+        rows = []
+        for item in items:
+            if isinstance(item, _string):
+                row = item.strip()
+            else:
+                knob, value = item
+                if value is None:
+                    row = knob
+                else:
+                    if _hasitems(value):
+                        value = self._tupletostr(value)
+                    row = '%s %s' % (knob, value)
+            if row:
+                rows.append(row)
+        skipped, update = {}, {}
+        if diff:
+            rows, skipped, update = self._diff(rows)
+            if skipped and self.cache is not None:
+                self._update_cache(
+                    ['%s %s' % item for item in skipped.items()],
+                    [''] * len(skipped))
+        if debug >= 3:
+            dprint('transaction: %s' % ('; '.join(rows),))
+        res = _nc_result(rows, self._transact(rows, timeout), skipped)
+        if diff:
+            self._update_applied(res, skipped, update)
+        return res
+
+    @staticmethod
+    def _applied_dir():
+        if _applied_folder is None:
+            import tempfile  # not needed unless differential init is used
+            return os.path.join(tempfile.gettempdir(), 'acq4xx_applied')
+        return _applied_folder
+
+    @classmethod
+    def _applied_file(cls, host):
+        return os.path.join(cls._applied_dir(), '%s.json' % (host,))
+
+    @classmethod
+    def load_applied(cls, host):
+        """Return the persisted snapshot of the settings applied to host."""
+        try:
+            with open(cls._applied_file(host)) as f:
+                applied = json.load(f)
+        except (IOError, OSError, ValueError):
+            applied = {}
+        applied.setdefault('sites', {})
+        applied.setdefault('skipped', {})
+        return applied
+
+    @classmethod
+    def save_applied(cls, host, applied):
+        folder = cls._applied_dir()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        path = cls._applied_file(host)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(applied, f)
+        os.rename(path + '.tmp', path)
+
+    @classmethod
+    def discard_applied(cls, host):
+        """Forget the settings applied to host, e.g. after reboot."""
+        with cls._applied_lock:
+            cls._applied.pop(host, None)
+        try:
+            os.remove(cls._applied_file(host))
+        except (IOError, OSError):
+            pass
+
+    @classmethod
+    def add_applied(cls, host):
+        """Enable differential transactions for host."""
+        applied = cls.load_applied(host)
+        applied['skipped'] = {}
+        with cls._applied_lock:
+            cls._applied[host] = applied
+
+    @classmethod
+    def remove_applied(cls, host, save=True):
+        """Disable differential transactions and persist the snapshot."""
+        with cls._applied_lock:
+            applied = cls._applied.pop(host, None)
+        if applied is None:
+            return None
+        if save:
+            cls.save_applied(host, applied)
+        else:
+            cls.discard_applied(host)
+        return applied
+
+    def _diff(self, rows):
+        """Split rows into rows to send and unchanged settings to skip."""
+        applied = self._applied.get(self._server[0], None)
+        if applied is None:
+            return rows, {}, {}
+        with self._applied_lock:
+            last = dict(applied['sites'].get(str(self._site), {}))
+        knobs = [row.split(' ', 1)[0] for row in rows]
+        send, skipped, update = [], {}, {}
+        for knob, row in zip(knobs, rows):
+            value = row[len(knob)+1:].strip()
+            if (
+                value and
+                knobs.count(knob) == 1 and
+                knob not in self._nodiff and
+                self.filter_result(knob, '', [value])[1] is not None
+            ):
+                if last.get(knob, None) == value:
+                    skipped[knob] = value
+                    continue
+                update[knob] = value
+            send.append(row)
+        return send, skipped, update
+
+    def _update_applied(self, res, skipped, update):
+        applied = self._applied.get(self._server[0], None)
+        if applied is None:
+            return
+        site = str(self._site)
+        with self._applied_lock:
+            last = applied['sites'].setdefault(site, {})
+            for knob, value in update.items():
+                if knob in res.errors:
+                    last.pop(knob, None)
+                else:
+                    last[knob] = value
+            if skipped:
+                applied['skipped'].setdefault(site, {}).update(skipped)
+
+    def verify(self, knobs):
+        """Return the knobs of a {knob: value} dict that read back different.
+
+        Readings are compared by their first word, numerically if possible.
+        """
+        res = self.transaction([(knob, None) for knob in knobs])
+
+        def same(read, value):
+            if read is None:
+                return False
+            read = read.split(' ', 1)[0] if read else read
+            if read == value:
+                return True
+            try:
+                return float(read) == float(value)
+            except ValueError:
+                return False
+        return dict((knob, value) for knob, value in knobs.items()
+                    if not same(res.get(knob, None), value))
+
     def _com(self, cmd, ans=False, timeout=5):
         dbg = [None, None]
         super(_dtacq_nc, self)._com(cmd, ans, timeout, dbg)
         if (
+            not self._pooled and
             dbg[0] is not None and
             dbg[1] is not None and
             self.cache is not None
@@ -1335,17 +2615,6 @@ class _dtacq_nc(_nc, _dtacq_knobs):
         if ans:
             return dbg[1]
 
-    @staticmethod
-    def _callerisinit(ignore):
-        stack = inspect.stack()[2:]
-        for call in stack:
-            if call[3] == ignore:
-                continue
-            if call[3] == '__init__':
-                return True
-            break
-        return False
-
     def _getfromdict(self, name):
         for cls in self.__class__.mro():
             if cls is _nc:
@@ -1355,19 +2624,6 @@ class _dtacq_nc(_nc, _dtacq_knobs):
             except KeyError:
                 continue
 
-    def __getattribute__(self, name):
-        v = _nc.__getattribute__(self, name)
-        if name.startswith('_'):
-            return v
-        if name in ('_server', '_com', '_getfromdict'):
-            return v
-        if isinstance(v, type):
-            if issubclass(v, (_KNOBS._grp,)):
-                return v(self)
-            elif issubclass(v, (_KNOBS._str,)):
-                return v(self).__get__(self, self.__class__)
-        return v
-
     def __getattr__(self, name):
         if name.startswith('_'):
             return super(_dtacq_nc, self).__getattribute__(name)
@@ -1382,13 +2638,14 @@ class _dtacq_nc(_nc, _dtacq_knobs):
             if hasattr(self.__class__, name):
                 super(_dtacq_nc, self).__setattr__(name, value)
         except AttributeError:
-            if not _dtacq_nc._callerisinit('__setattr__'):
+            if not self._init_mode:
                 return self(name, value)
             return super(_dtacq_nc, self).__setattr__(name, value)
 
 
 class _carrier_nc(_dtacq_nc, _carrier_knobs):
     _log = None
+    _retry_interval = 1.  # s between arm/abort resends while not taken
     ai_sites = ao_sites = None  # preset so setattr does not try knob
     _exclude = _dtacq_nc._exclude + [
         'get.site', 'reboot',
@@ -1406,31 +2663,50 @@ class _carrier_nc(_dtacq_nc, _carrier_knobs):
 
     @property
     def log(self):
-        if self._log is None:
+        if self._log is None or not self._log.on:
             self._log = STATE.logger(self._server[0], debug)
         return self._log
 
     def channel(self, i):
         return _channel_nc(i, self._server[0])
 
-    def wait(self, timeout, condition, breakcond):
+    def wait(self, timeout, condition, breakcond, retry=None):
+        """Block on state events until breakcond holds.
+
+        condition may query the appliance and returns False if there is
+        nothing to wait for. breakcond is evaluated on every state event
+        and must only use the logger. retry is called every
+        _retry_interval seconds since the last send, whether state events
+        arrive or not, and resends if the state still asks for it.
+        """
         if timeout is not None:
             timeout = time.time()+timeout
         ok = [True]  # python way of defining a pointer
-        with self.log.cv:
+        log = self.log
+        with log.cv:
             if condition(self, ok):
-                while self.log.on:
+                sent = time.time()
+                while log.on:
                     if breakcond(self, ok):
                         break
-                    if timeout is not None and (time.time() > timeout):
-                        ok[0] = False
-                        break
-                    self.log.cv.wait(1)
+                    now, wait = time.time(), None
+                    if retry is not None:
+                        if now - sent >= self._retry_interval:
+                            retry(self)
+                            sent = now
+                        wait = sent + self._retry_interval - now
+                    if timeout is not None:
+                        left = timeout - now
+                        if left <= 0:
+                            ok[0] = False
+                            break
+                        wait = left if wait is None else min(wait, left)
+                    log.cv.wait(wait)
                 else:
                     raise Exception('logger terminated')
             if debug:
                 dprint(self.state)
-        return self.log.on and ok[0]
+        return log.on and ok[0]
 
     def wait4state(self, state, timeout=None):
         if state not in STATE.names:
@@ -1439,8 +2715,7 @@ class _carrier_nc(_dtacq_nc, _carrier_knobs):
         def condition(self, ok):
             if self.state['state'] == state:
                 return False
-            if state in self.log._state:
-                self.log._state.remove(state)
+            self.log._state.discard(state)
             return True
 
         def breakcond(self, ok):
@@ -1454,43 +2729,38 @@ class _carrier_nc(_dtacq_nc, _carrier_knobs):
         def condition(self, ok):
             if not self.state['state'] in waitstates:
                 return False
-            if STATE.ARM in self.log._state:
-                self.log._state.remove(STATE.ARM)
+            self.log._state.discard(STATE.ARM)
             self.TRANSIENT.SET_ARM()
             return True
 
         def breakcond(self, ok):
-            if (
-                STATE.ARM in self.log._state or
-                self.state['state'] not in waitstates
-            ):
-                return True
-            self.TRANSIENT.SET_ARM()
-            return False
-        return self.wait(timeout, condition, breakcond)
+            current = self.log._current
+            return STATE.ARM in self.log._state or (
+                current is not None and current not in waitstates)
+
+        def retry(self):
+            if self.state['state'] in waitstates:
+                self.TRANSIENT.SET_ARM()
+
+        return self.wait(timeout, condition, breakcond, retry)
 
     def wait4post(self, post, timeout=None):
         waitstates = (STATE.ARM, STATE.PRE, STATE.POST)
 
         def condition(self, ok):
-            if (
-                self.state['state'] not in waitstates or
-                self.state['post'] >= post
-            ):
+            state = self.state
+            if state['state'] not in waitstates or state['post'] >= post:
                 return False
-            if STATE.STOP in self.log._state:
-                self.log._state.remove(STATE.STOP)
+            self.log._state.discard(STATE.STOP)
             return True
 
         def breakcond(self, ok):
-            state = self.state
-            if (
-                STATE.STOP in self.log._state or
-                state['state'] == STATE.STOP or
-                state['post'] >= post
-            ):
-                return True
-            return False
+            log = self.log
+            return (
+                STATE.STOP in log._state or
+                log._current == STATE.STOP or
+                log._post >= post
+            )
 
         return self.wait(timeout, condition, breakcond)
 
@@ -1511,15 +2781,16 @@ class _carrier_nc(_dtacq_nc, _carrier_knobs):
             return True
 
         def breakcond(self, ok):
-            if (
+            return (
                 STATE.STOP in self.log._state or
-                self.state['state'] == STATE.STOP
-            ):
-                return True
-            self.TRANSIENT.SET_ABORT()
-            return False
+                self.log._current == STATE.STOP
+            )
 
-        return self.wait(timeout, condition, breakcond)
+        def retry(self):
+            if self.state['state'] != STATE.STOP:
+                self.TRANSIENT.SET_ABORT()
+
+        return self.wait(timeout, condition, breakcond, retry)
 
     def __call__(self, cmd, value=None, site=0, **kw):
         if not cmd.strip():
@@ -1531,54 +2802,68 @@ class _carrier_nc(_dtacq_nc, _carrier_knobs):
     def _init(self, ext, mb_fin, mb_set, pre, post, soft_out, demux, shot=1):
         if not self.wait4abort(timeout=30):
             raise Exception('Could not abort.')
+        gets = []
         if self.ai_sites is not None:
-            sites = self._tupletostr(self.ai_sites)
-            if sites != self.aggregator['sites']:
-                self.run0(sites)
-                self.aggregator
+            gets.append(('aggregator', None))
         if self.ao_sites is not None:
-            sites = self._tupletostr(self.ao_sites)
-            if sites != self.distributor['sites']:
-                self.play0(sites)
-                self.distributor
+            gets.append(('distributor', None))
+        items = []
+        if gets:
+            res = self.transaction(gets).check()
+            if self.ai_sites is not None:
+                sites = self._tupletostr(self.ai_sites)
+                if sites != _KNOBS._aggr._rcast(res['aggregator'])['sites']:
+                    items.extend([('run0', sites), ('aggregator', None)])
+            if self.ao_sites is not None:
+                sites = self._tupletostr(self.ao_sites)
+                if sites != _KNOBS._aggr._rcast(res['distributor'])['sites']:
+                    items.extend([('play0', sites), ('distributor', None)])
         if shot is not None:
-            self.shot = shot
-        self._setup_clock(ext, mb_fin, mb_set)
-        self._setup_trigger(pre, post, soft_out, demux)
+            items.append(('shot', int(shot)))
+        items.extend(self._setup_clock(ext, mb_fin, mb_set))
+        items.extend(self._setup_trigger(pre, post, soft_out, demux))
+        self.transaction(items, timeout=15, diff=True).check()
 
     def _setup_clock(self, ext, mb_fin, mb_set):
+        """Return the transaction items to setup the clock."""
         if ext:
-            self.SYS.CLK.FPMUX = 'FPCLK'
+            items = [('SYS:CLK:FPMUX', 'FPCLK')]
             if debug:
                 dprint('Using external clock source')
         else:
-            self.SIG.ZCLK_SRC = 0  # INT33M
-            self.SYS.CLK.FPMUX = 'ZCLK'
+            items = [
+                ('SIG:ZCLK_SRC', 0),  # INT33M
+                ('SYS:CLK:FPMUX', 'ZCLK'),
+            ]
             if debug:
                 dprint('Using internal clock source')
-        self.SIG.CLK_MB.FIN = mb_fin
-        self.SIG.CLK_MB.SET = mb_set  # = clk * clkdiv
-        self.SIG.SRC.CLK[0] = 0
-        self.SIG.SRC.CLK[1] = 0  # MCLK
+        return items + [
+            ('SIG:CLK_MB:FIN', mb_fin),
+            ('SIG:CLK_MB:SET', mb_set),  # = clk * clkdiv
+            ('SIG:SRC:CLK:0', 0),
+            ('SIG:SRC:CLK:1', 0),  # MCLK
+        ]
 
     def _setup_trigger(self, pre, post, soft_out, demux):
-        # setup Front Panel TRIG port
-        self.SIG.FP.TRG = 'INPUT'
-        # setup signal source for external trigger and software trigger
-        self.SIG.SRC.TRG[0] = 0  # 'EXT'
-        self.SIG.SRC.TRG[1] = 0  # 'STRIG'
+        """Return the transaction items to setup the trigger."""
         soft_out = 1 if pre > 0 else soft_out
-        self.live_mode = 2 if pre else 1
-        self.live_pre = pre
-        self.live_post = post
-        self.TRANSIENT_ALL(pre=pre,
-                           post=post,
-                           osam=1,
-                           repeat=0,
-                           soft_out=soft_out,
-                           demux=demux)
         if debug:
             dprint('PRE: %d, POST: %d', pre, post)
+        return [
+            # setup Front Panel TRIG port
+            ('SIG:FP:TRG', 'INPUT'),
+            # setup signal source for external trigger and software trigger
+            ('SIG:SRC:TRG:0', 0),  # 'EXT'
+            ('SIG:SRC:TRG:1', 0),  # 'STRIG'
+            ('live_mode', 2 if pre else 1),
+            ('live_pre', pre),
+            ('live_post', post),
+        ] + self._transient_items(pre=pre,
+                                  post=post,
+                                  osam=1,
+                                  repeat=0,
+                                  soft_out=soft_out,
+                                  demux=demux)
 
 
 class _acq1001_nc(_carrier_nc, _acq1001_knobs):
@@ -1598,11 +2883,14 @@ class _acq2106_nc(_carrier_nc, _acq2106_knobs):
                 time.sleep(.2)
         set_plan = not ext and mb_set in [
             10000000, 20000000, 24000000, 40000000, 50000000, 80000000]
-        super(_acq2106_nc, self)._setup_clock(ext, mb_fin, mb_set)
+        items = super(_acq2106_nc, self)._setup_clock(ext, mb_fin, mb_set)
         if set_plan:
-            self.SYS.CLK.Si5326.PLAN = '%02dM' % (mb_set//1000000,)
-            self.SIG.CLK_MB.SET = 0  # auto
-        self.SYS.CLK.OE_CLK1_ZYNQ = 1
+            items.extend([
+                ('SYS:CLK:Si5326:PLAN', '%02dM' % (mb_set//1000000,)),
+                ('SIG:CLK_MB:SET', 0),  # auto
+            ])
+        items.append(('SYS:CLK:OE_CLK1_ZYNQ', 1))
+        return items
 
 
 class _module_nc(_dtacq_nc, _module_knobs):
@@ -1634,10 +2922,15 @@ class _module_nc(_dtacq_nc, _module_knobs):
                 return 0
         return mode
 
-    def _init(self, shot=None):
+    def _init_items(self, shot=None):
+        items = []
         if shot is not None:
-            self.shot = shot
-        self.data32 = 0
+            items.append(('shot', int(shot)))
+        items.append(('data32', 0))
+        return items
+
+    def _init(self, shot=None):
+        self.transaction(self._init_items(shot), diff=True).check()
 
     def _init_master(self, pre, soft):
         self.SIG.sample_count.RESET()
@@ -1684,11 +2977,10 @@ class _acq425_nc(_module_nc, _acq425_knobs):
         self.clkdiv = self.CLKDIV = clkdiv
 
     def _init(self, gain=None, shot=None):
-        self.chain_start()
-        super(_acq425_nc, self)._init(shot)
+        items = self._init_items(shot)
         if gain is not None:
-            self._com(self.GAIN.setall(gain))
-        self.chain_send()
+            items.extend(self.GAIN.setall(gain))
+        self.transaction(items, diff=True).check()
 
 
 class _acq480_nc(_module_nc, _acq480_knobs):
@@ -1719,19 +3011,18 @@ class _acq480_nc(_module_nc, _acq480_knobs):
 
     def _init(self, gain=None, invert=None, hpf=None, lfns=None, t50r=None,
               shot=None):
-        self.chain_start()
-        super(_acq480_nc, self)._init(shot)
+        items = self._init_items(shot)
         if gain is not None:
-            self._com(self.ACQ480.GAIN.setall(gain))
+            items.extend(self.ACQ480.GAIN.setall(gain))
         if invert is not None:
-            self._com(self.ACQ480.INVERT.setall(invert))
+            items.extend(self.ACQ480.INVERT.setall(invert))
         if hpf is not None:
-            self._com(self.ACQ480.HPF.setall(hpf))
+            items.extend(self.ACQ480.HPF.setall(hpf))
         if lfns is not None:
-            self._com(self.ACQ480.LFNS.setall(lfns))
+            items.extend(self.ACQ480.LFNS.setall(lfns))
         if t50r is not None:
-            self._com(self.ACQ480.T50R.setall(t50r))
-        self.chain_send()
+            items.extend(self.ACQ480.T50R.setall(t50r))
+        self.transaction(items, diff=True).check()
 
     def _init_master(self, pre, soft, mode=None, translen=None, fir=0):
         mode = self._trig_mode(mode)
@@ -1754,6 +3045,10 @@ class _acq480_nc(_module_nc, _acq480_knobs):
 
 
 class _ao420_nc(_module_nc, _ao420_knobs):
+    # the expression is evaluated and its reply is needed on every init
+    _nodiff = _module_nc._nodiff + [
+        'AO:EXPR:CH:%d' % ch for ch in range(1, 5)]
+
     def set_gain_offset(self, ch, gain, offset):
         if gain+abs(offset) > 100:
             gain = gain/2.
@@ -1772,8 +3067,14 @@ class _ao420_nc(_module_nc, _ao420_knobs):
         offset = min(100, max(-100, offset))
         self.D[ch] = int(round(offset*32767/100.))
 
+    @staticmethod
+    def _expr_item(ch, expr):
+        return 'AO:EXPR:CH:%d "%s"' % (ch, expr)
+
     def set_expr(self, ch, expr):
-        ans = self('AO:EXPR:CH:%d "%s"' % (ch, expr))
+        return self._expr_result(ch, expr, self(self._expr_item(ch, expr)))
+
+    def _expr_result(self, ch, expr, ans):
         ans = tuple(int(a) for a in ans.split(' ', 3))
         if self.cache is not None:
             self.cache['AO:EXPR:CH:%d' % ch] = str(expr)
@@ -1783,10 +3084,12 @@ class _ao420_nc(_module_nc, _ao420_knobs):
         return ans
 
     def _init(self, exprs, shot=None):
-        self.chain_start()
-        super(_ao420_nc, self)._init(shot)
-        self.chain_send()
-        return tuple(self.set_expr(i+1, exprs[i]) for i in range(4))
+        items = self._init_items(shot)
+        items.extend(self._expr_item(i+1, exprs[i]) for i in range(4))
+        res = self.transaction(items, timeout=10, diff=True).check()
+        return tuple(
+            self._expr_result(i+1, exprs[i], res['AO:EXPR:CH:%d' % (i+1,)])
+            for i in range(4))
 
     def _init_master(self, soft, clkdiv):
         self.chain_start()
@@ -2001,11 +3304,26 @@ class _streaming(ABC):
             """Get number of Channels."""
             pass
 
-        def store(self, i0, block):
-            """Store block[sample,channel]."""
+        def store(self, i0, block, part=None):
+            """Store block[sample,channel].
+
+            part: (k, n) stores every n-th channel from k, see writers.
+            """
             self.dev.dprint(
                 0, '%s.store %s', self.__class__.__name__, NotImplemented)
         triggered = False
+        writers = 0  # threads storing the blocks, 0: the stream itself
+        writer_depth = 8  # blocks queued per writer
+        writer_policy = 'block'  # if a writer is full: 'spill' or 'drop'
+        spill_folder = None  # <tempdir>
+        writer = None
+        capture = False  # only write the raw blocks to capture files
+        capture_folder = None  # <tempdir>
+        tap = None  # name of a shared memory ring of the blocks, see _tap
+        tap_slots = 16
+        tap_ring = None
+        pool_size = 4  # receive buffers: filling, storing and queued
+        received = None, None  # pool and buffer of the current block
 
         def __init__(self, dev, name, share):
             if name is None:
@@ -2035,66 +3353,210 @@ class _streaming(ABC):
             self._aborted.set()
             self.stop()
 
+        def buffer_pool(self, size):
+            """Pool of receive buffers, the slots of the tap if enabled."""
+            if not self.tap:  # writers keep up to writer_depth blocks
+                return _buffer_pool(size, self.pool_size + (
+                    self.writer_depth if self.writers else 0))
+            self.tap_ring = _tap(
+                self.tap, self.tap_slots, size, self.nChannels,
+                getattr(self, 'chanlist', None), self.clock, self.has_es)
+            return _buffer_pool(size, buffers=self.tap_ring.slots)
+
+        def hand_over(self, block):
+            """Return block kept valid for a writer and (pool, buffer).
+
+            A block in the current receive buffer holds that buffer until
+            it goes back to the pool; other blocks that can change, e.g.
+            the rows collected by run_es, are copied.
+            """
+            pool, buf = self.received
+            if buf is not None and numpy.may_share_memory(
+                    block, numpy.frombuffer(buf, numpy.uint8)):
+                pool.hold(buf)
+                return block, (pool, buf)
+            if block.flags.writeable:
+                return block.copy(), None
+            return block, None
+
+        def prefetch(self, pool, fill):
+            """Yield (buffer, nbytes) from pool as filled by fill(buffer).
+
+            A receiver thread fills the next buffers while the consumer
+            processes the current one, which goes back to the pool once
+            the next is requested. A short fill ends the stream.
+            """
+            ready = queue.Queue()
+            done = threading.Event()
+            tap = self.tap_ring
+
+            def receive():
+                error = None
+                try:
+                    while not (done.is_set() or self.aborted):
+                        try:
+                            buf = pool.get(timeout=1)
+                        except queue.Empty:
+                            continue
+                        if tap is not None:
+                            tap.begin(buf)
+                        nbytes = fill(buf)
+                        if tap is not None:
+                            tap.publish(buf, nbytes)
+                        ready.put((buf, nbytes, None))
+                        if nbytes < pool.size:
+                            break
+                except Exception as e:
+                    error = e
+                finally:
+                    ready.put((None, 0, error))
+            thread = threading.Thread(
+                target=receive, name="%s.receive" % self.name)
+            thread.daemon = True
+            thread.start()
+            try:
+                while True:
+                    buf, nbytes, error = ready.get()
+                    if buf is None:
+                        if error is not None:
+                            raise error
+                        return
+                    try:
+                        if nbytes:
+                            self.received = pool, buf
+                            yield buf, nbytes
+                    finally:
+                        pool.put(buf)
+            finally:
+                done.set()
+                idle = 0
+                while thread.is_alive() or not ready.empty():
+                    try:
+                        buf = ready.get(timeout=.1)[0]
+                    except queue.Empty:
+                        idle += 1
+                        if idle == 10 and not self.stopped:
+                            self.stop()  # receiver still waits for data
+                        continue
+                    if buf is not None:
+                        pool.put(buf)
+                if debug > 0:
+                    dprint("[%s] %s", self.name, pool)
+                if tap is not None:
+                    tap.close()
+
         def run(self):
+            if self.capture:
+                return self.capture_run()
+            if not self.writers:
+                self.put = self.store
+                return self.receive()
+            self.writer = _writer_stage(
+                self, self.writers, self.writer_depth, self.writer_policy,
+                self.spill_folder)
+            self.put = self.writer.put
+            try:
+                self.receive()
+            finally:
+                self.writer.close()
+
+        @property
+        def capture_path(self):
+            return os.path.join(_capture.folder(self.capture_folder),
+                                "%s_%s" % (self.dev.id, self.name))
+
+        def capture_run(self):
+            """Append the raw blocks to a capture, see _streaming.Replay."""
+            capture, i0 = None, 0
+            try:
+                for a in self.buffers():
+                    if capture is None:
+                        chanlist = getattr(self, 'chanlist', None)
+                        capture = self.capture_file = _capture(
+                            self.capture_path, {
+                                'nChannels': a.shape[1],
+                                'nSamples': self.nSamples,
+                                'clock': self.clock,
+                                'dtype': a.dtype.str,
+                                'has_es': bool(self.has_es),
+                                'chanlist': None if chanlist is None
+                                else list(chanlist),
+                            })
+                    capture.append(i0, a)
+                    i0 += a.shape[0]
+            finally:
+                if capture is not None:
+                    capture.close()
+
+        def receive(self):
             if self.has_es:
                 return self.run_es()
             self.cur_idx = 0
             for a in self.buffers():
-                self.store(self.cur_idx, a)
+                self.put(self.cur_idx, a)
                 self.cur_idx += a.shape[0]
 
         def run_es(self):
             clock_div = self.dev.es_clock_div
             self.cur_idx = 0
             self.trg_count = None
-
-            def reset_remaining():
-                self.es_remaining = numpy.zeros((0, self.nChannels), 'int16')
-
-            def store_if():
-                if self.es_remaining.shape[0] >= self.nSamples:
-                    self.store(self.cur_idx,
-                               self.es_remaining[:self.nSamples, :])
-                    self.cur_idx += self.nSamples
-                    self.es_remaining = self.es_remaining[self.nSamples:, :]
+            nSamples = self.nSamples
+            remaining = _es_buffer(nSamples, self.nChannels)
+
+            def append(rows):
+                if not remaining and rows.shape[0] >= nSamples:
+                    self.put(self.cur_idx, rows[:nSamples])
+                    self.cur_idx += nSamples
+                    rows = rows[nSamples:]
+                    if rows.shape[0]:
+                        remaining.append(rows)
+                    return
+                remaining.append(rows)
+                if len(remaining) >= nSamples:
+                    self.put(self.cur_idx, remaining.view(nSamples))
+                    self.cur_idx += nSamples
+                    remaining.consume(nSamples)
 
             def store_rest():
-                if self.es_remaining.size > 0:
-                    self.store(self.cur_idx, self.es_remaining)
-                    reset_remaining()
-
-            def find_marks(a):
-                if a.size == 0:
-                    return numpy.empty(0, 'bool')
-                return numpy.nonzero(
-                        (a[:, _es_marker.static] == _es_marker.int16.static)
-                        .all(1)
-                    )[0]
-
-            def get_count(a, mark):
-                return int(
-                    numpy.frombuffer(a[mark, _es_marker.count].data, 'int32')
-                    [0])
-            reset_remaining()
+                if remaining:
+                    self.put(self.cur_idx, remaining.view())
+                    remaining.clear()
+
             for a in self.buffers():
                 pos = 0
-                for mark in find_marks(a):
-                    count = get_count(a, mark)
+                marks, counts = _es_marker.scan(a)
+                for mark, count in zip(marks.tolist(), counts.tolist()):
                     if self.trg_count is None:
                         self.trg_count = count
                     else:
-                        self.es_remaining = numpy.concatenate(
-                                (self.es_remaining, a[pos:mark, :]), 0)
-                        store_if()
+                        append(a[pos:mark, :])
                         store_rest()
                         self.cur_idx = (count-self.trg_count)//clock_div
                     pos = mark + 1
-                if pos < self.nSamples:
-                    self.es_remaining = numpy.concatenate(
-                            (self.es_remaining, a[pos:, :]), 0)
-                    store_if()
+                if pos < nSamples:
+                    append(a[pos:, :])
             store_rest()
 
+    class Replay(Stream):
+        """Feed the blocks of a capture through store, e.g. to the tree."""
+        nSamples = nChannels = clock = chanlist = None
+        capture = False
+
+        def __init__(self, dev, path, share=None):
+            super(_streaming.Replay, self).__init__(
+                dev, "replay(%s)" % os.path.basename(path), share)
+            self.source = _capture(path)
+            meta = self.source.meta
+            self.nSamples = meta['nSamples']
+            self.nChannels = meta['nChannels']
+            self.clock = meta['clock']
+            self.chanlist = meta['chanlist']
+
+        @property
+        def has_es(self): return self.source.meta['has_es']
+
+        def buffers(self): return self.source.read()
+
     def streaming_arm(self, before, stream, after):
         if self._streams is not None:
             raise Exception("Streams already initialized.")
@@ -2182,7 +3644,7 @@ class _streaming_eth(_streaming):
     def deinit_stream_eth(self): pass
 
     class Stream_eth(_streaming.Stream):
-        nSamples = 0x40000
+        nSamples = 0x40000  # per received block, not per stored segment
         nChannels = "set in __init__"
         clock = "set in __init__"
 
@@ -2202,9 +3664,10 @@ class _streaming_eth(_streaming):
         @property
         def trigger(self): return int(self.dev._setting_trigger)
 
-        def recv(self, sock, req_bytes, timeout=True):
-            buf = bytearray(req_bytes)
-            view = memoryview(buf)
+        def recv(self, sock, req_bytes, timeout=True, buf=None):
+            if buf is None:
+                buf = bytearray(req_bytes)
+            view = memoryview(buf)[:req_bytes]
             rem_bytes = req_bytes
             while rem_bytes > 0 and not self.aborted:
                 try:
@@ -2230,29 +3693,30 @@ class _streaming_eth(_streaming):
         def buffers(self):
             buflen = self.nSamples*self.nChannels*2
             # should be multiple of bufferlen
-            shape = (self.nSamples, self.nChannels)
+            pool = self.buffer_pool(buflen)
+            blocks = []
+
+            def fill(buf):
+                # wait for trigger on the first block
+                read = self.recv(self.sock, buflen, bool(blocks), buf)[0]
+                blocks.append(read)
+                if read:
+                    self.triggered = True
+                return read
             try:
-                read = 0
                 self.sock.settimeout(1)
-                # wait for trigger
-                read, buf = self.recv(self.sock, buflen, False)
-                if read == 0:
-                    return
-                self.triggered = True
-                while read == buflen:
-                    yield numpy.frombuffer(buf, '<i2').reshape(shape)
-                    self.dev.dprint(5, "stream_eth yielded %r", shape)
-                    if self.aborted:
-                        return
-                    read, buf = self.recv(self.sock, buflen, True)
-                else:  # store rest
+                for buf, read in self.prefetch(pool, fill):
                     samples = read//self.nChannels//2
+                    shape = (samples, self.nChannels)
                     if samples > 0:
                         yield numpy.frombuffer(
-                            buf[:self.nChannels*samples*2], '<i2'
-                        ).reshape((self.nChannels, samples))
-                        self.dev.dprint(3, "stream_eth yielded %r", (
-                            self.nChannels, samples))
+                            buf, '<i2', samples*self.nChannels
+                        ).reshape(shape)
+                        self.dev.dprint(
+                            5 if read == buflen else 3,
+                            "stream_eth yielded %r", shape)
+                    if self.aborted:
+                        return
             except socket.timeout:
                 self.dev.dprint(3, "stream_eth timeout")
             finally:
@@ -2337,8 +3801,7 @@ class _streaming_mgt482(_streaming_eth):
         nSamples = "set in buffers"
         nChannels = "set in __init__"
         clock = "set in __init__"
-        _folder = "/data"
-        dostore = False
+        capture_folder = "/data"
         post = -1  # for infinite
         chanlist = None
         _lib = None
@@ -2391,14 +3854,23 @@ class _streaming_mgt482(_streaming_eth):
                 self.nSamples = size//self.nChannels//2
                 idx, max_idx = 0, self.post//self.nSamples
                 shape = (self.nSamples, self.nChannels)
-                while not self.aborted:
-                    buffer = (ctypes.c_char*size)()
+                pool = self.buffer_pool(size)
+                block_t = ctypes.c_char*size
+                filled = [0]
+
+                def fill(buf):
+                    if self.post >= 0 and filled[0] > max_idx:
+                        return 0
+                    buffer = block_t.from_buffer(buf)
                     for off in range(0, size, BUFLEN):
                         self.lib.RtmStreamGetBuffer(
                             self.HANDLE, ctypes.byref(buffer, off), buflen)
                         self.triggered = True
+                    filled[0] += 1
+                    return size
+                for buf, nbytes in self.prefetch(pool, fill):
                     yield numpy.frombuffer(
-                        buffer, dtype=numpy.int16).reshape(shape)
+                        buf, dtype=numpy.int16).reshape(shape)
                     if self.post >= 0 and idx >= max_idx:
                         break
                     idx += 1
@@ -2471,6 +3943,20 @@ class _carrier(_dtacq, _streaming):
     _setting_shot = 0
     _setting_pre = 0
     _setting_post = 0
+    _setting_differential = False  # only send settings changed since last init
+    _setting_downloaders = None  # channel download threads; None: tuned
+    _setting_pipelined = False  # store while downloading, see _store_segment
+    _setting_pack_windows = False  # store ES windows in few segments
+    _setting_read_pattern = 'sequential'  # how the data is read: 'random'
+    _segment_bytes = {'sequential': 1 << 21, 'random': 1 << 17}
+    _segment_memory = 1 << 26  # bytes of one segment of all channels
+    _segment_seconds = 10.  # longest span of a segment
+    _segment_align = 4096  # samples
+    _downloaders_default = 4
+    _downloaders_max = 8
+    _link_rate = 125e6  # bytes/s of the data link, 1 GbE
+    _download_tuning = {}  # host: pool size tuning of the transfers
+    download_stats = None
     ai_sites = None
     ao_sites = None
     @property
@@ -2575,7 +4061,11 @@ class _carrier(_dtacq, _streaming):
         self.nc.soft_trigger()  # SIG.SOFT_TRIGGER()
 
     def reboot(self):
-        self.nc.reboot()
+        try:
+            self.nc.reboot()
+        finally:
+            _nc_pool.close(self._setting_host)
+            _dtacq_nc.discard_applied(self._setting_host)
 
     def filter_commands(self, dic):
         if 0 in dic:
@@ -2599,10 +4089,43 @@ class _carrier(_dtacq, _streaming):
         self._setting_pre = int(pre)
         self._setting_post = int(post)
         self._master._setting_soft_out = bool(soft_out)
-        self._init()
+        self._init_applied()
         dic = _dtacq_nc.remove_cache(self._setting_host)
         self.store_commands(self.filter_commands(dic))
 
+    def _init_applied(self):
+        """Run _init, differential if enabled."""
+        if not self._setting_differential:
+            return _carrier._init(self)
+        _dtacq_nc.add_applied(self._setting_host)
+        ok = False
+        try:
+            _carrier._init(self)
+            ok = True
+        finally:
+            _dtacq_nc.remove_applied(self._setting_host, save=ok)
+
+    def _verify_applied(self):
+        """Read back and repair the settings skipped by a differential init."""
+        if not self._setting_differential:
+            return
+        host = self._setting_host
+        applied = _dtacq_nc.load_applied(host)
+        if not applied['skipped']:
+            return
+        ncs = {'0': self.nc}
+        for site in self._active_mods:
+            ncs[str(site)] = self.getmodule(site).nc
+        for site, knobs in applied['skipped'].items():
+            if site not in ncs:
+                continue
+            changed = ncs[site].verify(knobs)
+            if changed:
+                dprint('%s site %s: reapply %s', host, site, sorted(changed))
+                ncs[site].transaction(changed.items()).check()
+        applied['skipped'] = {}
+        _dtacq_nc.save_applied(host, applied)
+
     def _init(self):
         """Initialize all device settings."""
         ext = self.is_ext_clk
@@ -2631,6 +4154,7 @@ class _carrier(_dtacq, _streaming):
 
     def _arm_acq(self, timeout=50):
         """Arm the device for acq modules."""
+        self._verify_applied()
         if self.use_stream:
             return self.streaming_arm()
         timeout = int(timeout)
@@ -2638,6 +4162,7 @@ class _carrier(_dtacq, _streaming):
 
     def _arm_ao(self, ao_mode=AO_MODE.ONE_SHOT):
         """Arm the device for ao modules."""
+        self._verify_applied()
         try:
             self.nc.SET_AO_EXPR(ao_mode)
         finally:
@@ -2687,29 +4212,75 @@ class _carrier(_dtacq, _streaming):
     def off_slo(self): return self.nc.off_slo(self.modules)
 
     class _Downloader(threading.Thread):
-        def __init__(self, dev, chanlist, lock, queue):
+        abort = False
+
+        def __init__(self, dev, jobs, lock, queue, nsamples=None,
+                     segment=None, first=()):
             super(_carrier._Downloader, self).__init__()
             self.nc = dev.nc
-            self.list = chanlist
+            self.list = jobs
+            self.first = first
             self.lock = lock
             self.queue = queue
+            self.nsamples = nsamples
+            self.segment = segment
+            self.channels = self.bytes = 0
+            self.seconds = 0.
+            self.started = self.finished = time.time()
+
+        def segments(self, ch, on):
+            """Queue (ch, start, block, on) per segment, then (ch, None...).
+
+            The channel buffer is cut at segment boundaries, so each block
+            can be stored as received.
+            """
+            if on:
+                t = time.time()
+                try:
+                    is0 = 0
+                    channel = self.nc.channel(ch)
+                    for block in channel.buffer(self.segment * 2):
+                        if self.nsamples:
+                            block = block[:self.nsamples - is0]
+                        if not block.size or self.abort:
+                            channel.stop()
+                            break
+                        self.queue.put((ch, is0, block, on))
+                        is0 += block.size
+                        self.bytes += block.nbytes
+                    self.channels += 1
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception:
+                    traceback.print_exc()
+                self.seconds += time.time() - t
+            self.queue.put((ch, None, None, on))
 
         def run(self):
-            while True:
+            self.started = time.time()
+            while not self.abort:
                 with self.lock:
                     if not self.list:
                         break
-                    ch, slice = self.list.popitem()
-                    slice, on = slice
+                    ch, slice, on = self.list.pop()
+                if self.segment:
+                    self.segments(ch, on)
+                    continue
                 raw = None
-                if on:
+                if on or ch in self.first:
+                    t = time.time()
                     try:
-                        raw = self.nc.channel(ch).raw(slice)
+                        raw = self.nc.channel(ch).raw(slice, self.nsamples)
                     except (SystemExit, KeyboardInterrupt):
                         raise
                     except Exception:
                         traceback.print_exc()
+                    self.seconds += time.time() - t
+                    if raw is not None:
+                        self.channels += 1
+                        self.bytes += raw.nbytes
                 self.queue.put((ch, raw, on))
+            self.finished = time.time()
 
     def _get_chanlist(self):
         """Get a list of available channels with their corresponding module."""
@@ -2719,18 +4290,116 @@ class _carrier(_dtacq, _streaming):
             chanlist[ch] = (self._slice(ch), self.getchannel(ch).on)
         return (chanlist, queue.Queue(nchan))
 
-    def _start_threads(self, chanlist, queue):
-        """Start up to 8 threads for pulling the data."""
+    def _start_threads(self, chanlist, queue, nsamples=None, segment=None,
+                       first=()):
+        """Start up to 8 threads pulling the channels, largest first.
+
+        The channels in first are pulled before all others, even if off.
+        """
+        def size(item):
+            ch, (slc, on) = item
+            if not on:
+                return 0, -ch
+            if nsamples:
+                return len(range(*slc.indices(nsamples))), -ch
+            return 1. / abs(slc.step or 1), -ch
+        # the downloaders pop from the end
+        jobs = [(ch, slc, on)
+                for ch, (slc, on) in sorted(chanlist.items(), key=size)
+                if ch not in first]
+        jobs.extend((ch,) + chanlist[ch] for ch in reversed(first))
+        active = sum(1 for job in jobs if job[2] or job[0] in first)
         lock = threading.Lock()
         threads = []
-        for t in range(2):
-            threads.append(self._Downloader(self, chanlist, lock, queue))
+        for t in range(self._num_downloaders(active)):
+            threads.append(self._Downloader(
+                self, jobs, lock, queue, nsamples, segment, first))
         for t in threads:
             t.start()
         return threads
 
+    def _num_downloaders(self, nchan):
+        num = self._setting_downloaders
+        if num is None:
+            tuning = _carrier._download_tuning.get(self._setting_host)
+            num = self._downloaders_default if tuning is None else (
+                tuning['next'])
+        return max(1, min(int(num), self._downloaders_max, nchan))
+
+    def _join_threads(self, threads, tune=True):
+        """Join the downloaders, keep their throughput and tune the pool."""
+        for t in threads:
+            t.join()
+        nbytes = sum(t.bytes for t in threads)
+        wall = (max(t.finished for t in threads) -
+                min(t.started for t in threads))
+        self.download_stats = {
+            'bytes': nbytes,
+            'seconds': wall,
+            'rate': nbytes / wall if wall > 0 else 0.,
+            'threads': [{
+                'channels': t.channels,
+                'bytes': t.bytes,
+                'seconds': t.seconds,
+                'rate': t.bytes / t.seconds if t.seconds > 0 else 0.,
+            } for t in threads],
+        }
+        if debug:
+            dprint('download %d threads %7.1f MB/s (%s)', len(threads),
+                   self.download_stats['rate'] / 1e6, ', '.join(
+                       '%.1f' % (t['rate'] / 1e6)
+                       for t in self.download_stats['threads']))
+        if (tune and self._setting_downloaders is None and
+                nbytes and wall > 0):
+            self._tune_downloaders(len(threads), nbytes / wall)
+
+    def _tune_downloaders(self, num, rate):
+        """Size the pool of the next transfer from the last rates.
+
+        The pool grows towards the link rate as long as more threads paid
+        off by at least 10%; a size that did not is not tried again.
+        """
+        tuning = _carrier._download_tuning.setdefault(
+            self._setting_host,
+            {'best': (num, rate), 'limit': self._downloaders_max})
+        best_num, best_rate = tuning['best']
+        if num == best_num or rate > best_rate * 1.1:
+            tuning['best'] = best_num, best_rate = num, rate
+        elif num > best_num:
+            tuning['limit'] = num - 1
+        want = best_num
+        if best_rate < 0.9 * self._link_rate:
+            want = -(-best_num * self._link_rate // best_rate)
+        tuning['next'] = int(max(1, min(want, 2*best_num, tuning['limit'])))
+
     def get_dt(self): return 1000000000/self._setting_clock
 
+    def segment_samples(self, nchan=None, rate=None, pattern=None,
+                        itemsize=2):
+        """Samples per channel segment, shared by transient and streaming.
+
+        The read pattern sets the bytes per segment: large segments write
+        faster and suit sequential reads, small ones keep random access
+        reads short. A segment of all nchan channels must fit
+        _segment_memory, and at the sample rate it spans at most
+        _segment_seconds, so slow clocks still reach the tree in time.
+        """
+        if nchan is None:
+            nchan = self._num_channels
+        if rate is None:
+            rate = self._setting_clock
+        if pattern is None:
+            pattern = self._setting_read_pattern
+        size = min(self._segment_bytes[pattern],
+                   self._segment_memory // max(1, nchan)) // itemsize
+        if rate and self._segment_seconds:
+            size = min(size, int(rate * self._segment_seconds))
+        align = self._segment_align
+        return max(align, size // align * align)
+
+    @property
+    def _segment_size(self): return self.segment_samples()
+
     def _get_dim_slice(self, i0, start, end, pre, mcdf=1):
         """Calculate the time-vector."""
         first = int(i0-pre)
@@ -2752,7 +4421,7 @@ class _carrier(_dtacq, _streaming):
             dict of ch:raw data.
         """
         import matplotlib.pyplot as pp
-        chunksize = 1 << 18
+        chunksize = self._segment_size
         off_slo = self.off_slo
         for i in range(queue.maxsize):
             ch, value, on = queue.get()
@@ -2797,16 +4466,10 @@ class _carrier(_dtacq, _streaming):
         if s0 == s1:
             s0 = 4
 
-        def get_and_queue_put(ch):
-            slice, on = chanlist.pop(ch)
-            raw = self.nc.channel(ch).raw(slice)
-            queue.put((ch, raw, on))
-            return raw
-        loa = get_and_queue_put(lo)
-        hia = get_and_queue_put(hi)
-        s0a = get_and_queue_put(s0)
-        s1a = get_and_queue_put(s1)
-        threads = self._start_threads(chanlist, queue)
+        markers = (lo, hi, s0, s1)
+        # pre+post plus the event samples, so the channels read to the end
+        threads = self._start_threads(chanlist, queue, first=markers)
+        loa, hia, s0a, s1a = self._get_markers(markers, queue, threads)
         mask = ((s0a == _es_marker.int16.static) &
                 (s1a == _es_marker.int16.static))
         index = numpy.nonzero(mask)[0].astype('int32').tolist()
@@ -2816,27 +4479,196 @@ class _carrier(_dtacq, _streaming):
         tt0 = (loa+(hia << 16))//self.es_clock_div
         tt0 = (tt0-tt0[0]).tolist()
         pre = self._setting_pre
+        if self._setting_pack_windows:
+            # first sample, index[i]+1 to skip marker
+            windows = [(int(i0-pre), index[i]+1, index[i+1])
+                       for i, i0 in enumerate(tt0)]
+            self._store_windows_from_queue(windows, queue)
+            self._join_threads(threads)
+            return
         # i0 to shift time vector as well, index[i]+1 to skip marker
         dims_slice = [
             self._get_dim_slice(i0, index[i]+1, index[i+1], pre)
             for i, i0 in enumerate(tt0)
         ]
         self._store_channels_from_queue(dims_slice, queue)
-        for t in threads:
-            t.join()
+        self._join_threads(threads)
+
+    def _get_markers(self, markers, queue, threads):
+        """Take the marker channels from the queue as they arrive.
+
+        Channels that come in before all markers are put back, so the
+        store picks them up once the windows are known.
+        """
+        arrays, pending = {}, []
+        while len(arrays) < len(set(markers)):
+            item = queue.get()
+            pending.append(item)
+            if item[0] in markers:
+                arrays[item[0]] = item[1]
+        for item in pending:
+            queue.put(item)
+        failed = [ch for ch in markers if arrays[ch] is None]
+        if failed:
+            self._join_threads(threads, tune=False)
+            raise Exception("could not read marker channels %s" % failed)
+        return [arrays[ch] for ch in markers]
+
+    def _pack_windows(self, windows):
+        """Group consecutive (first, start, end) windows into packs.
+
+        A pack holds at most _segment_size samples unless a single window
+        is longer; empty windows are left out.
+        """
+        packs, pack, size = [], [], 0
+        limit = self._segment_size
+        for window in windows:
+            num = window[2]-window[1]
+            if num <= 0:
+                continue
+            if pack and size+num > limit:
+                packs.append(pack)
+                pack, size = [], 0
+            pack.append(window)
+            size += num
+        if pack:
+            packs.append(pack)
+        return packs
+
+    def _store_windows_from_queue(self, windows, queue):
+        """Store the ES windows of each channel packed into few segments."""
+        packs = self._pack_windows(windows)
+        off_slo = self.off_slo
+        for i in range(queue.maxsize):
+            ch, value, on = queue.get()
+            if value is None or not on:
+                continue
+            for n, pack in enumerate(packs):
+                data = numpy.concatenate(
+                    [value[start:end] for first, start, end in pack])
+                self._store_pack(ch, n, pack, data, off_slo)
+
+    def _store_pack(self, ch, n, pack, data, off_slo):
+        """Store the n-th pack of windows of channel ch."""
+        if debug > 1:
+            dprint("ch %d pack %d: %d windows, %d samples",
+                   ch, n, len(pack), data.shape[0])
 
     def _transfer_demuxed(self):
         """Grab the triggered channels, opens a socket and reads out data."""
         if debug:
             dprint('transfer_demuxed')
-        chanlist, queue = self._get_chanlist()
-        threads = self._start_threads(chanlist, queue)
+        chanlist, chanqueue = self._get_chanlist()
         pre = self._setting_pre
         dlen = pre+self._setting_post
         dims_slice = [self._get_dim_slice(0, 0, dlen, pre)]
-        self._store_channels_from_queue(dims_slice, queue)
-        for t in threads:
-            t.join()
+        full = slice(None, None, 1)
+        if self._setting_pipelined and all(
+                slc == full for slc, on in chanlist.values()):
+            return self._transfer_segments(chanlist, dims_slice[0], dlen)
+        threads = self._start_threads(chanlist, chanqueue, dlen)
+        self._store_channels_from_queue(dims_slice, chanqueue)
+        self._join_threads(threads)
+
+    def _transfer_segments(self, chanlist, dims_slice, dlen):
+        """Store segments while the channels are still downloading.
+
+        The downloaders queue segment sized blocks; the bounded queue keeps
+        memory at a few segments while the tree writes stay in this thread.
+        """
+        pipe = queue.Queue(2 * self._downloaders_max)
+        threads = self._start_threads(
+            chanlist, pipe, dlen, self._segment_size)
+        try:
+            self._store_segments_from_queue(dims_slice, pipe, len(chanlist))
+        except BaseException:
+            for t in threads:
+                t.abort = True
+            while any(t.is_alive() for t in threads):
+                try:
+                    pipe.get(timeout=.1)
+                except queue.Empty:
+                    pass
+            raise
+        finally:
+            self._join_threads(threads)
+
+    def _store_segments_from_queue(self, dims_slice, queue, nchan):
+        """Store the blocks of nchan channels in the order they arrive."""
+        off_slo = self.off_slo
+        while nchan:
+            ch, is0, block, on = queue.get()
+            if block is None:
+                nchan -= 1
+            elif on:
+                self._store_segment(ch, is0, block, dims_slice, off_slo)
+
+    def _store_segment(self, ch, is0, block, dims_slice, off_slo):
+        """Store block of channel ch starting at sample is0 of the slice."""
+        slc, start, dimfun, dmx = dims_slice
+        i0 = start+is0
+        i1 = i0+block.shape[0]-1
+        if debug > 1:
+            dprint("ch %d segment (%7.1fms,%7.1fms)",
+                   ch, dmx(i0)/1e6, dmx(i1)/1e6)
+
+    def _transfer_raw(self):
+        """Read the interleaved samples of all channels and demux them.
+
+        Data port 0 delivers whole frames of int16[nchan]. One downloader
+        pulls segment sized blocks while this thread demuxes each block
+        with a single transpose and stores the channel rows.
+        """
+        if debug:
+            dprint('transfer_raw')
+        chanlist, chanqueue = self._get_chanlist()
+        nchan = len(chanlist)
+        pre = self._setting_pre
+        dlen = pre+self._setting_post
+        dims_slice = self._get_dim_slice(0, 0, dlen, pre)
+        full = slice(None, None, 1)
+        pipelined = self._setting_pipelined and all(
+            slc == full for slc, on in chanlist.values())
+        if not pipelined:
+            data = numpy.empty((nchan, dlen), 'int16')
+        pipe = queue.Queue(4)
+        jobs, lock = [(0, None, True)], threading.Lock()
+        thread = self._Downloader(
+            self, jobs, lock, pipe, dlen*nchan, self._segment_size*nchan)
+        thread.start()
+        off_slo = self.off_slo
+        is0 = 0
+        try:
+            while True:
+                ch, pos, block, on = pipe.get()
+                if block is None:
+                    break
+                num = block.size // nchan
+                if pipelined:
+                    rows = _deinterleave(block, nchan)
+                    for ch, (slc, on) in chanlist.items():
+                        if on:
+                            self._store_segment(
+                                ch, is0, rows[ch-1], dims_slice, off_slo)
+                else:
+                    _deinterleave(block, nchan, data[:, is0:is0+num])
+                is0 += num
+        except BaseException:
+            thread.abort = True
+            while thread.is_alive():
+                try:
+                    pipe.get(timeout=.1)
+                except queue.Empty:
+                    pass
+            raise
+        finally:
+            self._join_threads([thread], tune=False)
+        if pipelined:
+            return
+        for ch, (slc, on) in chanlist.items():
+            # the channel slice as the data port of the channel would
+            chanqueue.put((ch, data[ch-1, :is0][slc] if on else None, on))
+        self._store_channels_from_queue([dims_slice], chanqueue)
 
 
 class _acq1001(_carrier, _streaming_eth):
@@ -2847,11 +4679,13 @@ class _acq1001(_carrier, _streaming_eth):
 
 class _acq2106(_carrier, _streaming_mgt482):
     _nc_class = _acq2106_nc
+    _link_rate = 1.25e9  # 10 GbE
     @property
     def _demux(self): return 0 if self.use_mgt or self.use_eth else 1
 
     def _arm_acq(self, *a, **kw):
         if self.use_mgt:
+            self._verify_applied()
             return self.streaming_arm()
         super(_acq2106, self)._arm_acq(*a, **kw)
 
@@ -3237,6 +5071,148 @@ class acq2106_acq480x6(_acq2106):
     """ACQ2106 carrier with six ACQ480 modules."""
 
 
+# --------------------------------
+#  5 rack: phases of many carriers
+# --------------------------------
+class rack(object):
+    """Run the shot phases of several carriers concurrently.
+
+    Each phase calls its carrier method in at most max_workers threads at
+    a time. A carrier that does not finish within timeout seconds is
+    reported as failed and its slot is given to the next carrier; python
+    cannot kill the thread, so it finishes in the background and later
+    phases fail that carrier until it did. Errors of all carriers are
+    collected and raised as one rack.error.
+
+    The wall clock time of every phase and the time of each carrier in it
+    are kept in timing, e.g. timing['store']['wall'].
+
+    init runs the public init of each carrier, so the keywords of rack.init
+    are its arguments and MDSplus devices record their COMMANDS as usual.
+    """
+
+    phases = {
+        'init': 'init',
+        'arm': '_arm_acq',
+        'store': '_store_acq',
+        'deinit': '_deinit_acq',
+    }
+
+    class error(Exception):
+        """Failures of one phase; errors maps carrier name to exception."""
+
+        def __init__(self, phase, errors, results):
+            self.phase = phase
+            self.errors = errors
+            self.results = results
+            super(rack.error, self).__init__('%s failed for %s' % (
+                phase, ', '.join(
+                    '%s: %s' % item for item in sorted(errors.items()))))
+
+    class timeout(Exception):
+        pass
+
+    def __init__(self, carriers, max_workers=8, timeout=None):
+        self.carriers = list(carriers)
+        self.max_workers = max(1, int(max_workers))
+        self.phase_timeout = timeout
+        self.timing = {}
+        self.busy = {}  # name: (phase, thread) of timed out carriers
+
+    @staticmethod
+    def name(carrier):
+        return str(carrier._setting_host)
+
+    def run(self, phase, *args, **kw):
+        """Call the phase method on all carriers; return results by name.
+
+        The keyword timeout overrides the per carrier timeout of the rack.
+        """
+        timeout = kw.pop('timeout', self.phase_timeout)
+        method = self.phases[phase]
+        pending = list(reversed(self.carriers))
+        running, threads = {}, {}  # name: start time, thread
+        results, errors, times = {}, {}, {}
+        for name, (busy, thread) in list(self.busy.items()):
+            if not thread.is_alive():
+                del(self.busy[name])
+        cv = threading.Condition()
+
+        def job(name, carrier):
+            try:
+                res, err = getattr(carrier, method)(*args, **kw), None
+            except Exception as exc:
+                res, err = None, exc
+            with cv:
+                if name in running:  # not timed out yet
+                    times[name] = time.time() - running.pop(name)
+                    if err is None:
+                        results[name] = res
+                    else:
+                        errors[name] = err
+                    cv.notify()
+
+        start = time.time()
+        with cv:
+            while pending or running:
+                while pending and len(running) < self.max_workers:
+                    carrier = pending.pop()
+                    name = self.name(carrier)
+                    if name in self.busy:  # never run two phases at once
+                        errors[name] = rack.timeout(
+                            '%s skipped, %s still running' % (
+                                phase, self.busy[name][0]))
+                        continue
+                    running[name] = time.time()
+                    thread = threads[name] = threading.Thread(
+                        target=job, args=(name, carrier),
+                        name='rack.%s(%s)' % (phase, name))
+                    thread.daemon = True
+                    thread.start()
+                wait = None
+                if timeout is not None:
+                    now = time.time()
+                    for name, begin in list(running.items()):
+                        if now - begin >= timeout:
+                            times[name] = now - running.pop(name)
+                            self.busy[name] = phase, threads[name]
+                            errors[name] = rack.timeout(
+                                '%s timed out after %.1f s' % (phase, timeout))
+                    if running:
+                        wait = max(0, min(running.values()) + timeout - now)
+                if running:
+                    cv.wait(wait)
+        self.timing[phase] = {'wall': time.time() - start, 'carriers': times}
+        if debug:
+            dprint(self.report(phase))
+        if errors:
+            raise rack.error(phase, errors, results)
+        return results
+
+    def report(self, phase):
+        """Return wall time, sum and slowest carrier of a phase."""
+        timing = self.timing[phase]
+        times = timing['carriers']
+        if not times:
+            return '%s: no carriers' % (phase,)
+        slowest = max(times, key=times.get)
+        return '%s: wall %.3f s, sum %.3f s, slowest %s %.3f s' % (
+            phase, timing['wall'], sum(times.values()),
+            slowest, times[slowest])
+
+    def init(self, **kw):
+        return self.run('init', **kw)
+
+    def arm(self, **kw):
+        return self.run('arm', **kw)
+
+    def store(self, **kw):
+        return self.run('store', **kw)
+
+    def deinit(self, **kw):
+        return self.run('deinit', **kw)
+
+
 def test(mode=STREAM_MODE.OFF, w_ao=True, w_ai=True):
     """Test some assembleys."""
     ai, ao = None, None
@@ -3327,6 +5303,250 @@ def test_stream_es():
         pp.show(block=True)
 
 
+def test_stream_es_rate(densities=(0, 4, 64, 1024), nblocks=32,
+                        nChannels=32, nSamples=0x10000):
+    """Time run_es on synthetic blocks with markers per block."""
+    class test_streaming(_streaming):
+        has_es = True
+        es_clock_div = 1
+
+        def get_dt(self): return 1.
+
+        class Stream(_streaming.Stream):
+            nChannels = nSamples = clock = None
+
+            def buffers(self):
+                return iter(self.blocks)
+
+            def store(self, i0, block):
+                self.stored += block.shape[0]
+
+    S = test_streaming()
+    for density in densities:
+        blocks, count = [], 0
+        for i in xrange(nblocks):
+            block = numpy.zeros((nSamples, nChannels), 'int16')
+            marks = xrange(0, nSamples, nSamples//density) if density else ()
+            for mark in marks:
+                count += 2*mark + 1
+                block[mark, _es_marker.static] = _es_marker.int16.static
+                block[mark, _es_marker.count] = numpy.array(
+                    [count], 'int32').view('int16')
+            blocks.append(block)
+        Ss = S.Stream(S, None, {})
+        Ss.nChannels, Ss.nSamples, Ss.clock = nChannels, nSamples, 1
+        Ss.blocks, Ss.stored = blocks, 0
+        t = time.time()
+        Ss.run()
+        t = time.time() - t
+        print('%5d marks/block %7.1f MB/s' % (
+            density, nblocks*nSamples*nChannels*2/t/1e6))
+
+
+def test_knob_access(number=100000):
+    """Time the attribute dispatch of knob groups; needs no appliance."""
+    nc = _acq2106_nc('localhost')
+    for path in ('TRANSIENT.SET_ARM', 'SIG.CLK_MB', 'SYS.CLK.Si5326'):
+        names = path.split('.')
+        t = time.time()
+        for i in xrange(number):
+            obj = nc
+            for name in names:
+                obj = getattr(obj, name)
+        print('%-20s %7.3f us' % (path, (time.time()-t)/number*1e6))
+
+
+def test_channel_read(nchan=32, nsamples=64 << 20):
+    """Compare chunked and preallocated channel reads over loopback."""
+    import tracemalloc
+    payload = memoryview(bytearray(nsamples * 2))
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+
+    def serve():
+        while True:
+            try:
+                con = srv.accept()[0]
+            except socket.error:
+                return
+            try:
+                con.sendall(payload)
+            finally:
+                con.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    ch = _channel_nc(0)
+    ch._server = srv.getsockname()
+    methods = (
+        ('chunked', lambda: numpy.concatenate(list(ch.buffer()), 0)),
+        ('prealloc', lambda: ch.read(nsamples=nsamples)),
+        ('growing', lambda: ch.read()),
+    )
+    try:
+        for name, read in methods:
+            tracemalloc.start()
+            t = time.time()
+            for i in xrange(nchan):
+                data = read()
+                assert data.size == nsamples
+                del(data)
+            t = time.time() - t
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('%-8s %7.1f MB/s  peak %7.1f MiB' % (
+                name, nchan*nsamples*2/t/1e6, peak/1048576.))
+    finally:
+        srv.close()
+
+
+def test_transfer_raw(nchan=32, nsamples=4 << 20, downloaders=4):
+    """Compare demuxed channel downloads with one demuxed raw stream."""
+    payload = memoryview(bytearray(nsamples * 2))
+    raw = memoryview(bytearray(nchan * nsamples * 2))
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(nchan)
+    sink = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sink.bind(('127.0.0.1', 0))
+    sink.listen(1)
+
+    def serve(srv, data):
+        while True:
+            try:
+                con = srv.accept()[0]
+            except socket.error:
+                return
+            try:
+                con.sendall(data)
+            finally:
+                con.close()
+    for args in ((srv, payload), (sink, raw)):
+        thread = threading.Thread(target=serve, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def demuxed():
+        jobs = list(xrange(nchan))
+        lock = threading.Lock()
+
+        def run():
+            while True:
+                with lock:
+                    if not jobs:
+                        return
+                    jobs.pop()
+                ch = _channel_nc(0)
+                ch._server = srv.getsockname()
+                assert ch.read(nsamples=nsamples).size == nsamples
+        threads = [threading.Thread(target=run) for i in xrange(downloaders)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def interleaved():
+        ch = _channel_nc(0)
+        ch._server = sink.getsockname()
+        blocks = queue.Queue(4)
+
+        def run():
+            for block in ch.buffer((1 << 18) * nchan * 2):
+                blocks.put(block)
+            blocks.put(None)
+        thread = threading.Thread(target=run)
+        thread.start()
+        num = 0
+        block = blocks.get()
+        while block is not None:
+            num += _deinterleave(block, nchan).shape[1]
+            block = blocks.get()
+        thread.join()
+        assert num == nsamples
+    try:
+        for name, transfer in (('demuxed', demuxed), ('raw', interleaved)):
+            t = time.time()
+            transfer()
+            t = time.time() - t
+            print('%-8s %7.1f MB/s' % (name, nchan*nsamples*2/t/1e6))
+    finally:
+        srv.close()
+        sink.close()
+
+
+def test_transfer_raw_slices(nchan=8, nsamples=10000):
+    """Check that raw transfers store the slice of each channel."""
+    frames = numpy.arange(nchan*nsamples, dtype='int16')
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(1)
+
+    def serve():
+        con = srv.accept()[0]
+        try:
+            con.sendall(frames.tobytes())
+        finally:
+            con.close()
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    slices = {2: slice(None, None, 3), 3: slice(100, 200),
+              4: slice(-50, None), 5: slice(None, None, -7)}
+    stored = {}
+
+    class carrier_nc(object):
+        @staticmethod
+        def channel(ch):
+            chan = _channel_nc(ch)
+            chan._server = srv.getsockname()
+            return chan
+
+    class channel(object):
+        on = True
+
+    class carrier(_carrier):
+        _num_channels = nchan
+        _setting_post = nsamples
+        nc = carrier_nc
+        off_slo = None
+
+        def getchannel(self, ch): return channel
+
+        def _slice(self, ch): return slices.get(ch, slice(None, None, 1))
+
+        def _store_channels_from_queue(self, dims_slice, queue):
+            for i in range(queue.maxsize):
+                ch, value, on = queue.get()
+                stored[ch] = value[dims_slice[0][0]]
+    try:
+        carrier.__new__(carrier)._transfer_raw()
+    finally:
+        srv.close()
+    frames = frames.reshape(nsamples, nchan)
+    for ch in range(1, nchan+1):
+        expect = frames[:, ch-1][slices.get(ch, slice(None))]
+        assert stored[ch].shape == expect.shape, ch
+        assert (stored[ch] == expect).all(), ch
+
+
+def test_startup(number=5):
+    """Time a fresh import of this module, excluding numpy."""
+    import subprocess
+    code = ';'.join((
+        'import time, numpy',
+        't = time.time()',
+        'import acq4xx',
+        'i = time.time()',
+        'acq4xx._acq2106_nc("localhost").SYS.CLK.Si5326',
+        'print("%.3f %.3f" % ((i-t)*1e3, (time.time()-i)*1e3))'))
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    for i in xrange(number):
+        ans = subprocess.check_output([sys.executable, '-c', code], cwd=cwd)
+        print('import %s ms, first knob access %s ms' % tuple(
+            s(ans).split()))
+
+
 try:
     import MDSplus
 except Exception:
@@ -3353,32 +5573,82 @@ else:
                             yield i, raw
                 self.dev.tree.open()
                 self._chans = tuple(gen_chan_nodes())
+                self._rows = {}
+                self._segment = self.dev.segment_samples(len(self._chans))
                 self._i1_max = self.dev.trigger_post
                 super(_STREAMING.Stream, self).run()
 
-            def store(self, i0, block):
+            def channel_rows(self, block, chans, part):
+                """Transpose the enabled channels of block into reused rows.
+
+                Each writer part has its own buffer; the rows are valid
+                until its next block.
+                """
+                buf = self._rows.get(part)
+                if buf is None or buf.shape[1] < block.shape[0]:
+                    buf = self._rows[part] = numpy.empty(
+                        (len(chans), block.shape[0]), block.dtype)
+                return _transpose(block, buf[:, :block.shape[0]],
+                                  [i for i, raw in chans])
+
+            def store(self, i0, block, part=None):
+                """Store block cut to the segment size policy of dev."""
+                step = self._segment
+                for is0 in xrange(0, block.shape[0], step):
+                    self.store_segment(i0+is0, block[is0:is0+step], part)
+
+            def store_segment(self, i0, block, part=None):
+                chans = self._chans
+                if part is not None:
+                    chans = chans[part[0]::part[1]]
+                if 0 <= self._i1_max < i0:
+                    return  # queued behind the last requested sample
+                if not chans:
+                    return
+                rows = self.channel_rows(block, chans, part)
                 i1 = self.dev.get_i1(i0, block.shape[0])
                 if self._i1_max < 0 or i1 < self._i1_max:
                     dim, dm0, dm1 = self.dev.get_dim_set(i0, i1)
-                    for i, raw in self._chans:
-                        raw.makeSegment(dm0, dm1, dim, block[:, i])
+                    for row, (i, raw) in zip(rows, chans):
+                        raw.makeSegment(dm0, dm1, dim, row)
+                        self.dev.store_preview(self.chanlist[i]+1, i0, row)
                 else:
                     upto, i1 = self._i1_max - i0, self._i1_max
                     dim, dm0, dm1 = self.dev.get_dim_set(i0, i1)
-                    for i, raw in self._chans:
-                        raw.makeSegment(dm0, dm1, dim, block[:upto, i])
+                    for row, (i, raw) in zip(rows, chans):
+                        raw.makeSegment(dm0, dm1, dim, row[:upto])
+                        self.dev.store_preview(
+                            self.chanlist[i]+1, i0, row[:upto])
                     self.dev.dprint(
                         1, "Stream.store reached requested samples.")
                     self.abort()
 
+        class Replay(Stream, _streaming.Replay):
+            def __init__(self, dev, path, share=None):
+                super(_STREAMING.Replay, self).__init__(dev, path, share)
+
+        def streaming_replay(self, folder=None):
+            """Store the captures of this shot to the tree afterwards."""
+            import glob
+            folder = _capture.folder(folder)
+            paths = sorted(glob.glob(os.path.join(folder, self.id + '_*')))
+            self.store_scale()
+            for path in paths:
+                self.dprint(1, "replay %s", path)
+                self.Replay(self, path).run()
+            return paths
+
         def store_scale(self):
             off_slo = self.off_slo
             for idx in range(self._num_channels):
                 ch = idx+1
                 node = self.getchannel(ch)
                 if node.on:
-                    node.setSegmentScale(
-                            self.get_scale(off_slo[idx][1], off_slo[idx][0]))
+                    scale = self.get_scale(off_slo[idx][1], off_slo[idx][0])
+                    node.setSegmentScale(scale)
+                    if self._preview_decim > 1:
+                        for name in ('min', 'max', 'mean'):
+                            self.getchannel(ch, name).setSegmentScale(scale)
 
     class _STREAMING_ETH(_STREAMING, _streaming_eth):
         class Stream_eth(_STREAMING.Stream, _streaming_eth.Stream_eth):
@@ -3494,6 +5764,32 @@ else:
                 self.get_dmx(i1, trg),
             )
 
+        def get_preview_dim_set(self, i0, num, decim, trg=None):
+            """Dimension of num preview points, one per decim samples."""
+            if trg is None:
+                trg = self.trigger
+            dt = self.get_dt()
+            return (
+                MDSplus.Dimension(
+                    MDSplus.Window(0, num-1, self.get_dmx(i0, trg)),
+                    MDSplus.Range(None, None, MDSplus.MULTIPLY(dt, decim))),
+                self.get_dmx(i0, trg),
+                self.get_dmx(i0+(num-1)*decim, trg),
+            )
+
+        def get_windows_dim_set(self, firsts, lasts, trg=None):
+            """Dimension of the windows of samples firsts[k]..lasts[k]."""
+            if trg is None:
+                trg = self.trigger
+            return (
+                MDSplus.Dimension(None, MDSplus.Range(
+                    self.get_dmx(MDSplus.Int64Array(firsts), trg),
+                    self.get_dmx(MDSplus.Int64Array(lasts), trg),
+                    self.get_dt())),
+                self.get_dmx(firsts[0], trg),
+                self.get_dmx(lasts[-1], trg),
+            )
+
         @staticmethod
         def update_dim_set(dim, dm0, dm1, i0, i1):
             dim[0][0], dim[0][1] = i0, i1
@@ -3591,6 +5887,32 @@ else:
              'filer': json.loads,
              },
         ]
+        _setting_preview = 0
+
+        @_cached_property
+        def _preview_decim(self):
+            # trees of older models end before the appended preview parts
+            offset = self.part_dict.get('preview')
+            if offset is None or offset >= len(self.conglomerate_nids):
+                return 0
+            return max(0, self._setting_preview)
+
+        def store_preview(self, ch, i0, data, scale=None):
+            """Store min, max and mean of data to the preview nodes of ch.
+
+            One point per _setting_preview samples, starting at sample i0.
+            """
+            decim = self._preview_decim
+            if decim <= 1:
+                return
+            envelope = _envelope(data, decim)
+            dim, dm0, dm1 = self.get_preview_dim_set(
+                i0, envelope[0].shape[0], decim)
+            for name, values in zip(('min', 'max', 'mean'), envelope):
+                node = self.getchannel(ch, name)
+                if scale is not None:
+                    node.setSegmentScale(scale)
+                node.makeSegment(dm0, dm1, dim, values)
 
         @staticmethod
         def _assemble(cls, module, num_modules=1):
@@ -3630,6 +5952,10 @@ else:
                 def _setting_post(self):
                     return self.__getattr__('trigger_post')
                 cls._setting_post = _setting_post
+                @MDSplus.mdsrecord(filter=int, default=0)
+                def _setting_preview(self):
+                    return self.__getattr__('preview')
+                cls._setting_preview = _setting_preview
             else:  # is AO420
                 cls.parts = list(_CARRIER.parts)
                 cls._setting_pre = 0
@@ -3646,6 +5972,16 @@ else:
                 module._addModuleKnobs(cls, prefix, i)
                 if i == 0:
                     module._addMasterKnobs(cls, prefix)
+            if module._is_ai:  # after all parts to keep their offsets
+                cls.parts.append(
+                    {'path': ':PREVIEW',
+                     'type': 'numeric',
+                     'value': 0,
+                     'help': 'samples per min/max/mean preview point, 0: off',
+                     'options': ('no_write_shot',),
+                     })
+                for i in range(num_modules):
+                    module._addPreviewKnobs(cls, ':MODULE%d' % (i+1), i)
 
         @property
         def is_test(self): return self.actionserver_soft_trigger.on
@@ -3721,7 +6057,7 @@ else:
             """
             _dtacq_nc.add_cache(self._setting_host)
             try:
-                _carrier._init(self)
+                _carrier._init_applied(self)
             except socket.error as e:
                 raise MDSplus.DevOFFLINE(str(e))
             except (SystemExit, KeyboardInterrupt):
@@ -3786,15 +6122,15 @@ else:
             queue: Queue
                 dict of ch:raw data.
             """
-            chunksize = 100000
+            chunksize = self._segment_size
             off_slo = self.off_slo
             for i in range(queue.maxsize):
                 ch, value, on = queue.get()
                 if value is None or not on:
                     continue
                 node = self.getchannel(ch)
-                node.setSegmentScale(
-                        self.get_scale(off_slo[ch-1][1], off_slo[ch-1][0]))
+                scale = self.get_scale(off_slo[ch-1][1], off_slo[ch-1][0])
+                node.setSegmentScale(scale)
                 for slc, start, dim, dm0, dm1 in dims_slice:
                     val = value[slc]
                     dlen = val.shape[0]
@@ -3806,6 +6142,41 @@ else:
                             dprint(
                                 "segment (%7.1fms,%7.1fms)", dm0/1e6, dm1/1e6)
                         node.makeSegment(dm0, dm1, dim, val[is0:is1+1])
+                        self.store_preview(
+                            ch, i0, val[is0:is1+1], scale if not seg else None)
+
+        def _store_pack(self, ch, n, pack, data, off_slo):
+            """Store a pack of windows as one segment of channel ch.
+
+            The dimension ranges over the windows, so it keeps their start
+            times while the tree gets one segment per pack.
+            """
+            node = self.getchannel(ch)
+            if n == 0:
+                node.setSegmentScale(
+                        self.get_scale(off_slo[ch-1][1], off_slo[ch-1][0]))
+            dim, dm0, dm1 = self.get_windows_dim_set(
+                [first for first, start, end in pack],
+                [first+end-start-1 for first, start, end in pack])
+            if debug > 1:
+                dprint("ch %d pack %d: %d windows", ch, n, len(pack))
+            node.makeSegment(dm0, dm1, dim, data)
+
+        def _store_segment(self, ch, is0, block, dims_slice, off_slo):
+            """Store block as the segment of channel ch starting at is0."""
+            slc, start, dim, dm0, dm1 = dims_slice
+            node = self.getchannel(ch)
+            scale = None
+            if is0 == 0:
+                scale = self.get_scale(off_slo[ch-1][1], off_slo[ch-1][0])
+                node.setSegmentScale(scale)
+            i0 = start+is0
+            self.update_dim_set(dim, dm0, dm1, i0, i0+block.shape[0]-1)
+            if debug > 1:
+                dprint("ch %d segment (%7.1fms,%7.1fms)",
+                       ch, dm0/1e6, dm1/1e6)
+            node.makeSegment(dm0, dm1, dim, block)
+            self.store_preview(ch, i0, block, scale)
 
         def _deinit_acq(self):
             """Abort and go to idle.
@@ -3878,6 +6249,18 @@ else:
                  },
             ])
 
+        @classmethod
+        def _addPreviewKnobs(cls, carrier, prefix, idx):
+            """Add the min, max and mean preview signals of the channels."""
+            start = carrier._channel_offset[idx]+1
+            for i in range(start, start+cls._num_channels):
+                carrier.parts.extend([
+                    {'path': '%s:CHANNEL%02d:%s' % (prefix, i, name),
+                     'type': 'signal',
+                     'options': ('no_write_model', 'write_once',),
+                     'help': '%s of each :PREVIEW samples' % (name.lower(),),
+                     } for name in ('MIN', 'MAX', 'MEAN')])
+
         def __getattr__(self, name):
             """Redirect Device.part_name to head."""
             partname = "module%d_%s" % (self.site, name)
@@ -4559,6 +6942,10 @@ else:
     def _run420():
         _runTests(_Tests.get420Tests())
 
+    def _runreplay(expt, shot, path, folder=None):
+        with MDSplus.Tree(expt, int(shot)) as tree:
+            tree.getNode(path).streaming_replay(folder)
+
     def _runmgtdram(blocks=10, uut='localhost'):
         blocks = int(blocks)
         m = _mgtdram_nc(uut)
@@ -4617,6 +7004,7 @@ else:
                 print('%s test480' % sys.argv[0])
                 print('%s test480x1' % sys.argv[0])
                 print('%s testmgtdram <blocks> [uut]' % sys.argv[0])
+                print('%s replay <tree> <shot> <path> [folder]' % sys.argv[0])
                 test_stream_es()
             else:
                 print(sys.argv[1:])
@@ -4635,3 +7023,5 @@ else:
                     _run420()
                 elif sys.argv[1] == 'testmgtdram':
                     _runmgtdram(*sys.argv[2:])
+                elif sys.argv[1] == 'replay':
+                    _runreplay(*sys.argv[2:])